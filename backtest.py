@@ -0,0 +1,560 @@
+# 추천 전략 오프라인 백테스트
+# activity 로그의 버튼 클릭(P/B/T, 승/패 피드백)으로 사용자별 슈(shoe)를 복원하고,
+# 여러 추천 전략을 같은 슈에 다시 돌려 적중률/연승·연패 통계/슈당 비용을 비교한다.
+# DB 는 청크 단위로 읽어 흘려보내고, 슈 묶음은 프로세스 풀에서 병렬로 평가한다.
+# LLM 전략은 기록된 응답 캐시(SQLite)만 사용하므로 기본적으로 API 를 호출하지 않는다.
+#
+# 사용 예)
+#   python backtest.py                                   # baccarat_stats.db 의 모든 슈, 기본 전략들
+#   python backtest.py --strategies local,llm --llm-cache backtest_cache.db
+#   python backtest.py --synthetic 100000 --workers 8    # 무작위 슈 10만 개로 엔진 속도/기준 성능 확인
+#   python backtest.py --strategies mymodule:MyStrategy  # 직접 만든 전략 (Strategy 를 상속)
+
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import datetime
+import importlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import telegram_bot as bot
+
+DEFAULT_STRATEGIES = "local,banker,follow,opposite"
+MIN_SHOE_HANDS = 5  # P/B 결과가 이보다 적은 슈는 건너뜀
+FEEDBACK_MATCH_SECONDS = 5  # 피드백 클릭과 results_log 기록 사이 허용 시간차
+STREAK_BUCKETS = 12  # 연승/연패 길이 분포 (마지막 칸은 그 이상)
+# gpt-4o 기준 1백만 토큰당 달러 (--prompt-price / --completion-price 로 변경)
+PROMPT_PRICE = 2.5
+COMPLETION_PRICE = 10.0
+ESTIMATED_COMPLETION_TOKENS = 200
+
+
+# --- 슈 복원 ---
+class FeedbackResults:
+    """사용자별 results_log 를 id 순서로 조금씩 읽어 피드백 클릭과 맞춰 보는 커서"""
+
+    def __init__(self, conn, user_id, chunk_size=256):
+        self.conn = conn
+        self.user_id = user_id
+        self.chunk_size = chunk_size
+        self.last_id = 0
+        self.pending = deque()
+        self.exhausted = False
+
+    def _peek(self):
+        if not self.pending and not self.exhausted:
+            rows = self.conn.execute(
+                "SELECT id, recommendation, outcome, created FROM results_log WHERE user_id=? AND id>? ORDER BY id LIMIT ?",
+                (self.user_id, self.last_id, self.chunk_size),
+            ).fetchall()
+            if rows:
+                self.last_id = rows[-1][0]
+                self.pending.extend(rows)
+            self.exhausted = len(rows) < self.chunk_size
+        return self.pending[0] if self.pending else None
+
+    def match(self, clicked_at, outcome):
+        """clicked_at 에 누른 승/패 피드백이 기록한 결과를 찾아 실제 승자('P'/'B')를 반환 (없으면 None)"""
+        while True:
+            row = self._peek()
+            if row is None:
+                return None
+            _, recommendation, logged_outcome, created = row
+            delta = (_parse_time(created) - clicked_at).total_seconds()
+            if delta < -FEEDBACK_MATCH_SECONDS:  # 이미 지나간 클릭의 기록
+                self.pending.popleft()
+                continue
+            if delta > FEEDBACK_MATCH_SECONDS or logged_outcome != outcome:
+                return None  # 추천이 없어 기록되지 않은 클릭
+            self.pending.popleft()
+            side = "P" if recommendation == "Player" else "B"
+            if outcome == "win":
+                return side
+            return "B" if side == "P" else "P"
+
+def _parse_time(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.fromisoformat(str(value))
+
+def read_shoes(db_path, chunk_size=50000, since=None, min_hands=MIN_SHOE_HANDS):
+    """activity 로그를 청크 단위로 읽으며 (user_id, 'PBT..' 기록) 슈를 하나씩 내보낸다
+    /start 또는 기록 초기화 버튼이 슈의 경계이며, 승/패 피드백 버튼은 results_log 의 추천으로 실제 결과를 복원한다."""
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    open_shoes = {}  # user_id -> 결과 목록
+    feedback = {}  # user_id -> FeedbackResults
+    try:
+        for _, user_id, timestamp, action, details in _activity_rows(conn, chunk_size, since):
+            if action == "start" or details == "reset":
+                shoe = open_shoes.pop(user_id, None)
+                if shoe and _pb_count(shoe) >= min_hands:
+                    yield user_id, "".join(shoe)
+            elif details in ("P", "B", "T"):
+                open_shoes.setdefault(user_id, []).append(details)
+            elif details in ("feedback_win", "feedback_loss") and user_id in open_shoes:
+                cursor = feedback.get(user_id)
+                if cursor is None:
+                    cursor = feedback[user_id] = FeedbackResults(conn, user_id)
+                winner = cursor.match(_parse_time(timestamp), details[len("feedback_"):])
+                if winner:
+                    open_shoes[user_id].append(winner)
+        for user_id, shoe in open_shoes.items():
+            if _pb_count(shoe) >= min_hands:
+                yield user_id, "".join(shoe)
+    finally:
+        conn.close()
+
+def _activity_rows(conn, chunk_size, since):
+    """보관된 행(activity_archive)부터 activity_id 순서로 start/button_click 행을 청크 단위로 읽음"""
+    tables = [name for (name,) in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('activity_archive', 'activity')"
+    )]
+    last_id = 0
+    for table in sorted(tables, key=lambda name: name != "activity_archive"):
+        while True:
+            rows = conn.execute(
+                f"""SELECT activity_id, user_id, timestamp, action, details FROM {table}
+                WHERE activity_id > ? AND action IN ('start', 'button_click') AND (? IS NULL OR timestamp >= ?)
+                ORDER BY activity_id LIMIT ?""",
+                (last_id, since, since, chunk_size),
+            ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            yield from rows
+
+def _pb_count(shoe):
+    return len(shoe) - shoe.count("T")
+
+def synthetic_shoes(count, hands=72, seed=1):
+    """무작위 슈 (8덱 기준 확률: Banker 45.86%, Player 44.62%, Tie 9.52%)"""
+    rng = random.Random(seed)
+    for i in range(count):
+        yield -1 - i, "".join(rng.choices("BPT", weights=(45.86, 44.62, 9.52), k=hands))
+
+
+# --- 전략 ---
+class Strategy:
+    """백테스트 전략의 기본 클래스
+    recommend() 는 다음 핸드 결과를 보기 전에 호출되며 'Player' / 'Banker' 또는 베팅하지 않으면 None 을 반환한다.
+    state 는 engine(PatternEngine), history('PBT..' 문자열), performance(최근 추천 실적) 를 가진다."""
+    name = "strategy"
+
+    def __init__(self, options):
+        self.options = options
+
+    def recommend(self, state):
+        raise NotImplementedError
+
+    def usage(self):
+        """평가하는 동안 쌓인 LLM 사용량 (호출, 캐시 적중, 캐시 미스, 입력 토큰, 출력 토큰) 을 돌려주고 초기화"""
+        return 0, 0, 0, 0, 0
+
+    def recorded(self):
+        """이번 평가에서 새로 받은 LLM 응답 (캐시에 저장할 목록) 을 돌려주고 비움"""
+        return []
+
+class LocalRulesStrategy(Strategy):
+    """프롬프트의 베팅 지침을 규칙으로 옮긴 로컬 패턴 엔진 (봇의 '로컬' 모드)"""
+    name = "local"
+
+    def recommend(self, state):
+        return state.local_recommendation()
+
+class AlwaysBankerStrategy(Strategy):
+    name = "banker"
+
+    def recommend(self, state):
+        return "Banker"
+
+class FollowLastStrategy(Strategy):
+    """직전 P/B 결과를 따라감 (지침 1이 피하라고 하는 기준선)"""
+    name = "follow"
+
+    def recommend(self, state):
+        return bot.RESULT_NAMES.get(state.engine.tail[-1:], "Banker")
+
+class OppositeLastStrategy(Strategy):
+    name = "opposite"
+
+    def recommend(self, state):
+        last = state.engine.tail[-1:]
+        return "Player" if last == "B" else "Banker"
+
+class LLMStrategy(Strategy):
+    """봇과 같은 프롬프트로 GPT 추천을 재현하는 전략
+    응답은 llm_cache 테이블(프롬프트 해시 -> 응답)에서 찾고, 없으면 로컬 엔진 추천으로 대신한다 (봇의 실패 시 동작과 같음).
+    --allow-api 를 주면 캐시에 없을 때만 실제 API 를 호출하고 응답을 기록한다."""
+    name = "llm"
+
+    def __init__(self, options):
+        super().__init__(options)
+        self.model = options.get("model", bot.OPENAI_MODEL)
+        self.allow_api = options.get("allow_api", False)
+        self.conn = None
+        cache_path = options.get("llm_cache")
+        if cache_path and os.path.exists(cache_path):
+            self.conn = sqlite3.connect(f"file:{cache_path}?mode=ro", uri=True)
+        self.client = None
+        self.new_entries = []
+        self.memo = {}  # 이번 프로세스에서 이미 찾은 응답
+        self.calls = self.hits = self.misses = self.prompt_tokens = self.completion_tokens = 0
+
+    def recommend(self, state):
+        messages = bot.build_recommendation_messages(
+            state.history, list(state.performance), state.engine.describe()
+        )
+        self.calls += 1
+        key = entry = None
+        if self.conn is not None or self.allow_api:  # 캐시도 API 도 없으면 키를 만들 필요가 없음
+            key = bot.prompt_key(self.model, messages)
+            entry = self.memo.get(key) or self._lookup(key)
+        if entry is None and self.allow_api:
+            entry = self._call_api(key, messages)
+        if entry is None:
+            self.misses += 1
+            self.prompt_tokens += estimate_tokens(messages)
+            self.completion_tokens += ESTIMATED_COMPLETION_TOKENS
+            return state.local_recommendation()
+        self.hits += 1
+        self.memo[key] = entry
+        response, prompt_tokens, completion_tokens = entry
+        self.prompt_tokens += prompt_tokens or estimate_tokens(messages)
+        self.completion_tokens += completion_tokens or ESTIMATED_COMPLETION_TOKENS
+        return bot.parse_recommendation(response)
+
+    def _lookup(self, key):
+        if self.conn is None:
+            return None
+        return self.conn.execute(
+            "SELECT response, prompt_tokens, completion_tokens FROM llm_cache WHERE key=?", (key,)
+        ).fetchone()
+
+    def _call_api(self, key, messages):
+        if self.client is None:
+            from openai import OpenAI
+            self.client = OpenAI(timeout=bot.OPENAI_TIMEOUT, max_retries=2)
+        try:
+            completion = self.client.chat.completions.create(model=self.model, messages=messages)
+        except Exception as e:
+            print(f"GPT-4 API Error: {e}")
+            return None
+        usage = completion.usage
+        entry = (
+            completion.choices[0].message.content,
+            usage.prompt_tokens if usage else 0,
+            usage.completion_tokens if usage else 0,
+        )
+        self.new_entries.append((key, self.model) + entry)
+        return entry
+
+    def usage(self):
+        counts = (self.calls, self.hits, self.misses, self.prompt_tokens, self.completion_tokens)
+        self.calls = self.hits = self.misses = self.prompt_tokens = self.completion_tokens = 0
+        return counts
+
+    def recorded(self):
+        entries, self.new_entries = self.new_entries, []
+        return entries
+
+def estimate_tokens(messages):
+    """메시지 목록 전체의 대략적인 토큰 수"""
+    return sum(bot.estimate_tokens(m["content"]) for m in messages)
+
+STRATEGIES = {
+    cls.name: cls for cls in (LocalRulesStrategy, AlwaysBankerStrategy, FollowLastStrategy, OppositeLastStrategy, LLMStrategy)
+}
+
+def load_strategy(spec, options):
+    """'local' 같은 등록된 이름이나 'module:ClassName' 으로 전략 생성"""
+    if spec in STRATEGIES:
+        return STRATEGIES[spec](options)
+    module_name, _, class_name = spec.partition(":")
+    if not class_name:
+        raise ValueError(f"알 수 없는 전략: {spec} (사용 가능: {', '.join(STRATEGIES)})")
+    strategy = getattr(importlib.import_module(module_name), class_name)(options)
+    if strategy.name == Strategy.name:
+        strategy.name = spec
+    return strategy
+
+
+# --- 평가 ---
+class ShoeState:
+    """한 슈를 진행하는 동안 모든 전략이 함께 보는 상태 (패턴 엔진은 슈마다 하나만 갱신)
+    performance 는 추천을 받는 전략의 최근 실적으로 바꿔 끼운다."""
+    __slots__ = ("engine", "history", "performance", "_local")
+
+    def __init__(self):
+        self.engine = bot.PatternEngine()
+        self.history = ""
+        self.performance = None
+        self._local = None
+
+    def local_recommendation(self):
+        """이번 핸드의 로컬 엔진 추천 (여러 전략이 같은 값을 쓰므로 핸드당 한 번만 계산)"""
+        if self._local is None:
+            self._local = self.engine.recommend()
+        return self._local
+
+    def add(self, winner):
+        self.engine.add(winner)
+        self.history += winner
+        self._local = None
+
+class StreakTracker:
+    """슈 안에서 전략 하나의 연승/연패와 적중 수를 센다"""
+    __slots__ = ("performance", "wins", "losses", "won", "length")
+
+    def __init__(self):
+        self.performance = deque(maxlen=bot.PERFORMANCE_HISTORY_SIZE)
+        self.wins = self.losses = self.length = 0
+        self.won = None
+
+class StrategyStats:
+    """전략별 집계 (프로세스 사이에서 주고받고 merge 로 합친다)"""
+    __slots__ = (
+        "name", "shoes", "hands", "bets", "wins", "losses", "pushes", "llm_calls", "cache_hits", "cache_misses",
+        "prompt_tokens", "completion_tokens", "win_streaks", "loss_streaks", "shoe_hit_rates",
+    )
+
+    def __init__(self, name):
+        self.name = name
+        self.shoes = self.hands = self.bets = self.wins = self.losses = self.pushes = 0
+        self.llm_calls = self.cache_hits = self.cache_misses = self.prompt_tokens = self.completion_tokens = 0
+        self.win_streaks = [0] * STREAK_BUCKETS  # 길이별 연승 횟수 (index = 길이-1)
+        self.loss_streaks = [0] * STREAK_BUCKETS
+        self.shoe_hit_rates = [0] * 21  # 슈별 적중률 5% 구간 분포
+
+    def add_streak(self, won, length):
+        if length:
+            (self.win_streaks if won else self.loss_streaks)[min(length, STREAK_BUCKETS) - 1] += 1
+
+    def merge(self, other):
+        for slot in self.__slots__[1:]:
+            value = getattr(self, slot)
+            if isinstance(value, list):
+                setattr(self, slot, [a + b for a, b in zip(value, getattr(other, slot))])
+            else:
+                setattr(self, slot, value + getattr(other, slot))
+        return self
+
+    def report(self, prompt_price=PROMPT_PRICE, completion_price=COMPLETION_PRICE):
+        decided = self.wins + self.losses
+        cost = (self.prompt_tokens * prompt_price + self.completion_tokens * completion_price) / 1e6
+        loss_runs = sum(self.loss_streaks)
+        return {
+            "strategy": self.name,
+            "shoes": self.shoes,
+            "hands": self.hands,
+            "bets": self.bets,
+            "wins": self.wins,
+            "losses": self.losses,
+            "pushes": self.pushes,
+            "hit_rate": self.wins / decided if decided else 0.0,
+            "longest_win_streak": _longest(self.win_streaks),
+            "longest_loss_streak": _longest(self.loss_streaks),
+            "mean_loss_streak": sum((i + 1) * n for i, n in enumerate(self.loss_streaks)) / loss_runs if loss_runs else 0.0,
+            "loss_streaks_5_plus": sum(self.loss_streaks[4:]),
+            "win_streaks": self.win_streaks,
+            "loss_streaks": self.loss_streaks,
+            "shoe_hit_rate_histogram": self.shoe_hit_rates,
+            "llm_calls": self.llm_calls,
+            "cache_hit_rate": self.cache_hits / self.llm_calls if self.llm_calls else None,
+            "tokens_per_shoe": (self.prompt_tokens + self.completion_tokens) / self.shoes if self.shoes else 0.0,
+            "cost_per_shoe_usd": cost / self.shoes if self.shoes else 0.0,
+            "total_cost_usd": cost,
+        }
+
+def _longest(streaks):
+    for i in range(len(streaks) - 1, -1, -1):
+        if streaks[i]:
+            return i + 1 if i < len(streaks) - 1 else f"{len(streaks)}+"
+    return 0
+
+def evaluate_shoe(strategies, stats_list, shoe):
+    """슈 하나를 처음부터 다시 진행하며 매 핸드 직전에 모든 전략의 추천을 받아 채점"""
+    state = ShoeState()
+    trackers = [StreakTracker() for _ in strategies]
+    for winner in shoe:
+        for strategy, stats, tracker in zip(strategies, stats_list, trackers):
+            state.performance = tracker.performance
+            recommendation = strategy.recommend(state)
+            if not recommendation:
+                continue
+            if winner == "T":
+                stats.pushes += 1
+                continue
+            stats.bets += 1
+            won = recommendation[0] == winner
+            if won:
+                tracker.wins += 1
+            else:
+                tracker.losses += 1
+            tracker.performance.append({"recommendation": recommendation, "outcome": "win" if won else "loss"})
+            if won == tracker.won:
+                tracker.length += 1
+            else:
+                stats.add_streak(tracker.won, tracker.length)
+                tracker.won, tracker.length = won, 1
+        state.add(winner)
+
+    hands = len(shoe) - shoe.count("T")
+    for stats, tracker in zip(stats_list, trackers):
+        stats.add_streak(tracker.won, tracker.length)
+        stats.shoes += 1
+        stats.hands += hands
+        stats.wins += tracker.wins
+        stats.losses += tracker.losses
+        decided = tracker.wins + tracker.losses
+        if decided:
+            stats.shoe_hit_rates[round(tracker.wins / decided * 20)] += 1
+
+_worker_strategies = None
+
+def _init_worker(specs, options):
+    global _worker_strategies
+    _worker_strategies = [load_strategy(spec, options) for spec in specs]
+
+def evaluate_batch(shoes):
+    """슈 묶음을 이 프로세스의 모든 전략으로 평가해 (전략별 집계, 새로 기록된 LLM 응답) 을 반환"""
+    results = [StrategyStats(strategy.name) for strategy in _worker_strategies]
+    for _, shoe in shoes:
+        evaluate_shoe(_worker_strategies, results, shoe)
+    recorded = []
+    for strategy, stats in zip(_worker_strategies, results):
+        (stats.llm_calls, stats.cache_hits, stats.cache_misses,
+         stats.prompt_tokens, stats.completion_tokens) = strategy.usage()
+        recorded.extend(strategy.recorded())
+    return results, recorded
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def save_recorded(cache_path, entries):
+    """새로 받은 LLM 응답을 캐시 DB 에 저장 (부모 프로세스 하나만 쓴다)"""
+    if not entries:
+        return
+    with sqlite3.connect(cache_path) as conn:
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, model TEXT, response TEXT,
+            prompt_tokens INTEGER, completion_tokens INTEGER, created TEXT DEFAULT CURRENT_TIMESTAMP)"""
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO llm_cache (key, model, response, prompt_tokens, completion_tokens) VALUES (?, ?, ?, ?, ?)",
+            entries,
+        )
+
+def run_backtest(shoes, specs, options, workers=os.cpu_count(), batch_size=200, progress=None):
+    """슈 스트림을 batch_size 개씩 묶어 (workers 개 프로세스로) 평가하고 전략별 StrategyStats 를 반환"""
+    totals = {}
+
+    def collect(result):
+        stats_list, recorded = result
+        for stats in stats_list:
+            if stats.name in totals:
+                totals[stats.name].merge(stats)
+            else:
+                totals[stats.name] = stats
+        if options.get("llm_cache"):
+            save_recorded(options["llm_cache"], recorded)
+        if progress:
+            progress(totals)
+
+    if workers <= 1:
+        _init_worker(specs, options)
+        for batch in batched(shoes, batch_size):
+            collect(evaluate_batch(batch))
+        return totals
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(specs, options)) as pool:
+        in_flight = set()
+        for batch in batched(shoes, batch_size):
+            in_flight.add(pool.submit(evaluate_batch, batch))
+            if len(in_flight) >= workers * 2:  # 읽기가 평가보다 앞서 나가지 않도록 제한
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future.result())
+        for future in in_flight:
+            collect(future.result())
+    return totals
+
+
+# --- 실행 ---
+def print_report(reports, elapsed):
+    hands = max((r["hands"] for r in reports), default=0)
+    shoes = max((r["shoes"] for r in reports), default=0)
+    print(f"\n슈 {shoes}개, P/B 핸드 {hands}개 평가 ({elapsed:.1f}초, {hands / elapsed if elapsed else 0:,.0f} 핸드/초)")
+    print(f"{'전략':<12}{'적중률':>8}{'승':>9}{'패':>9}{'최장연승':>9}{'최장연패':>9}{'평균연패':>9}{'5연패+':>8}{'LLM캐시':>9}{'슈당비용($)':>12}")
+    for r in reports:
+        cache = f"{r['cache_hit_rate']:.0%}" if r["cache_hit_rate"] is not None else "-"
+        print(
+            f"{r['strategy']:<12}{r['hit_rate']:>8.2%}{r['wins']:>9}{r['losses']:>9}{str(r['longest_win_streak']):>9}"
+            f"{str(r['longest_loss_streak']):>9}{r['mean_loss_streak']:>9.2f}{r['loss_streaks_5_plus']:>8}{cache:>9}"
+            f"{r['cost_per_shoe_usd']:>12.4f}"
+        )
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="추천 전략 오프라인 백테스트")
+    parser.add_argument("--db", default=bot.DB_FILE, help="봇 DB 경로")
+    parser.add_argument("--strategies", default=DEFAULT_STRATEGIES,
+                        help=f"쉼표로 구분한 전략 목록 ({', '.join(STRATEGIES)} 또는 module:Class)")
+    parser.add_argument("--since", help="이 시각 이후 activity 만 사용 (예: 2025-08-01)")
+    parser.add_argument("--min-hands", type=int, default=MIN_SHOE_HANDS, help="평가할 슈의 최소 P/B 결과 수")
+    parser.add_argument("--synthetic", type=int, default=0, help="DB 대신 무작위 슈 N개로 평가")
+    parser.add_argument("--shoe-hands", type=int, default=72, help="무작위 슈 길이")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="평가 프로세스 수 (1이면 현재 프로세스)")
+    parser.add_argument("--chunk-size", type=int, default=50000, help="activity 를 한 번에 읽을 행 수")
+    parser.add_argument("--batch-size", type=int, default=200, help="프로세스에 한 번에 넘길 슈 수")
+    parser.add_argument("--llm-cache", default="backtest_cache.db", help="LLM 응답 캐시 DB 경로")
+    parser.add_argument("--allow-api", action="store_true", help="캐시에 없는 LLM 응답은 실제 API 로 받아 기록 (비용 발생)")
+    parser.add_argument("--model", default=bot.OPENAI_MODEL)
+    parser.add_argument("--prompt-price", type=float, default=PROMPT_PRICE, help="입력 1백만 토큰당 달러")
+    parser.add_argument("--completion-price", type=float, default=COMPLETION_PRICE, help="출력 1백만 토큰당 달러")
+    parser.add_argument("--json", help="결과를 JSON 으로 저장할 경로")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    specs = [spec.strip() for spec in args.strategies.split(",") if spec.strip()]
+    for spec in specs:
+        load_strategy(spec, {})  # 잘못된 전략 이름은 시작 전에 알림
+    options = {"llm_cache": args.llm_cache, "allow_api": args.allow_api, "model": args.model}
+    if args.synthetic:
+        shoes = synthetic_shoes(args.synthetic, args.shoe_hands)
+    else:
+        if not os.path.exists(args.db):
+            sys.exit(f"DB 파일이 없습니다: {args.db}")
+        shoes = read_shoes(args.db, args.chunk_size, args.since, args.min_hands)
+
+    started = time.perf_counter()
+    last_print = [started]
+
+    def progress(totals):
+        now = time.perf_counter()
+        if now - last_print[0] >= 5:
+            last_print[0] = now
+            stats = next(iter(totals.values()))
+            print(f"  ... 슈 {stats.shoes}개, 핸드 {stats.hands}개 ({now - started:.0f}초)", file=sys.stderr)
+
+    totals = run_backtest(shoes, specs, options, args.workers, args.batch_size, progress)
+    elapsed = time.perf_counter() - started
+    reports = [totals[name].report(args.prompt_price, args.completion_price) for name in totals]
+    print_report(reports, elapsed)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"elapsed_seconds": elapsed, "strategies": reports}, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
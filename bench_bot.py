@@ -0,0 +1,429 @@
+# 바카라 봇 벤치마크 / 부하 테스트
+# 실제 텔레그램/OpenAI 대신 지연 시간을 조절할 수 있는 가짜 백엔드를 붙여서
+# 가상 사용자 수천 명이 /start 와 버튼 클릭을 보내는 상황을 재현하고 핸들러 지연/처리량/렌더링/DB 쓰기/세션 메모리를 측정한다.
+#
+# 사용 예)
+#   python bench_bot.py                                  # 기본 부하 테스트 + 마이크로 벤치마크
+#   python bench_bot.py --users 2000 --hands 300         # 긴 슈(shoe) 부하
+#   python bench_bot.py --micro-only --save base.json    # 배포 전 기준값 저장
+#   python bench_bot.py --micro-only --compare base.json # 기준값보다 느려졌으면 종료 코드 1
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from types import SimpleNamespace
+
+# telegram_bot 은 import 시점에 환경변수를 읽으므로 먼저 가짜 값을 넣는다
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:bench")
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+import telegram_bot as bot
+
+BOT_ID = 123456
+
+
+# --- 가짜 백엔드 ---
+class StubTelegramRequest(BaseRequest):
+    """Bot API 요청을 네트워크 없이 지연 시간 후 성공 응답으로 돌려주는 가짜 텔레그램 서버"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self._next_message_id = 1
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api = url.rsplit("/", 1)[-1]
+        self.calls[api] = self.calls.get(api, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        if api == "getMe":
+            result = {"id": BOT_ID, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif api in ("sendPhoto", "editMessageMedia", "editMessageCaption", "editMessageReplyMarkup"):
+            message_id = params.get("message_id")
+            if message_id is None:
+                message_id = self._next_message_id
+                self._next_message_id += 1
+            result = {
+                "message_id": message_id, "date": int(time.time()),
+                "chat": {"id": params.get("chat_id", 0), "type": "private"},
+                "photo": [{"file_id": f"bench-{api}-{message_id}", "file_unique_id": "u", "width": 440, "height": 162}],
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class StubOpenAI:
+    """chat.completions.create 만 흉내 내는 가짜 OpenAI 클라이언트"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, **kwargs):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        content = f"분석 결과 흐름을 보면... 추천: {random.choice(('Player', 'Banker'))}"
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(prompt_tokens=len(kwargs["messages"][-1]["content"]) // 2, completion_tokens=20),
+        )
+
+
+# --- 측정 도구 ---
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    k = (len(ordered) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+def summarize(samples):
+    """초 단위 측정값 목록을 ms 단위 요약으로"""
+    if not samples:
+        return {"count": 0}
+    return {
+        "count": len(samples),
+        "mean_ms": sum(samples) / len(samples) * 1000,
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p95_ms": percentile(samples, 95) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+        "max_ms": max(samples) * 1000,
+    }
+
+class Timings:
+    """렌더링/DB 쓰기 함수를 감싸 걸린 시간을 모은다 (DB 쓰기는 writer 스레드에서 호출됨)"""
+
+    def __init__(self):
+        self.render = []
+        self.db_batches = []
+        self.db_rows = 0
+        self._lock = threading.Lock()
+
+    def install(self):
+        renderer = bot.road_renderer
+        render_page = renderer.render_page
+
+        def timed_render_page(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return render_page(*args, **kwargs)
+            finally:
+                self.render.append(time.perf_counter() - started)
+
+        renderer.render_page = timed_render_page
+
+        write_batch = bot.DBWriter._write_batch
+        timings = self
+
+        def timed_write_batch(writer, conn, batch):
+            started = time.perf_counter()
+            try:
+                return write_batch(writer, conn, batch)
+            finally:
+                if batch:
+                    with timings._lock:
+                        timings.db_batches.append(time.perf_counter() - started)
+                        timings.db_rows += len(batch)
+
+        bot.DBWriter._write_batch = timed_write_batch
+
+
+# --- 가상 사용자 ---
+def start_update(update_id, user_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": 1, "date": int(time.time()), "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"},
+        },
+    }
+
+def callback_update(update_id, user_id, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id), "chat_instance": str(user_id), "data": data,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"},
+            "message": {
+                "message_id": 1, "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "bench"},
+            },
+        },
+    }
+
+def shoe_actions(rng, hands, feedback_rate):
+    """한 슈 동안 누를 버튼 목록 (P/B/T 결과와 가끔 AI 추천 피드백)"""
+    actions = []
+    for _ in range(hands):
+        actions.append(rng.choices("PBT", weights=(45, 46, 9))[0])
+        if rng.random() < feedback_rate:
+            actions.append(rng.choice(("feedback_win", "feedback_loss")))
+    return actions
+
+async def run_virtual_user(application, user_id, actions, think, limiter, latencies, ids):
+    updates = [start_update(next(ids), user_id)]
+    updates += [callback_update(next(ids), user_id, action) for action in actions]
+    for data in updates:
+        update = Update.de_json(data, application.bot)
+        async with limiter:
+            started = time.perf_counter()
+            await application.process_update(update)
+            latencies.append(time.perf_counter() - started)
+        if think:
+            await asyncio.sleep(think * random.uniform(0.5, 1.5))
+
+async def run_load(args, timings):
+    telegram = StubTelegramRequest(args.telegram_latency)
+    openai = StubOpenAI(args.openai_latency)
+    bot.client = openai
+    if not args.real_rate_limits:
+        bot.outbound = bot.OutboundScheduler(global_rate=1e9, chat_rate=1e9, chat_burst=1e9)
+
+    application = bot.build_application(request=telegram)
+    await application.initialize()
+    rng = random.Random(args.seed)
+    ids = iter(range(1, 1 << 62))
+    limiter = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    # /start 가 세션을 초기화하므로 자동 분석은 첫 버튼으로 켠다
+    first = [] if args.no_auto_analysis else ["toggle_auto_analysis"]
+    shoes = [first + shoe_actions(rng, args.hands, args.feedback_rate) for _ in range(args.users)]
+    for user_id in range(1, args.users + 1):
+        session = bot.session_store.get(user_id)
+        session.recommender_mode = args.mode
+        bot.session_store.save(session)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        run_virtual_user(application, user_id, shoe, args.think, limiter, latencies, ids)
+        for user_id, shoe in enumerate(shoes, start=1)
+    ])
+    handled = time.perf_counter() - started
+    # 디바운스된 분석/화면 갱신과 발신 대기열, DB 쓰기까지 끝나야 처리 완료
+    await bot.drain_background_tasks()
+    await bot.outbound.join()
+    await asyncio.to_thread(bot.db_writer.flush, 60)
+    settled = time.perf_counter() - started
+    await application.shutdown()
+
+    return {
+        "users": args.users,
+        "hands_per_user": args.hands,
+        "updates": len(latencies),
+        "handler_seconds": handled,
+        "settled_seconds": settled,
+        "throughput_updates_per_s": len(latencies) / handled if handled else 0.0,
+        "handler_latency": summarize(latencies),
+        "render": summarize(timings.render),
+        "db_write_batch": summarize(timings.db_batches),
+        "db_rows": timings.db_rows,
+        "db_dropped": bot.db_writer.dropped,
+        "telegram_calls": telegram.calls,
+        "openai_calls": openai.calls,
+        "render_cache": {"hits": bot.render_cache.hits, "misses": bot.render_cache.misses},
+        "prompt_cache": {
+            "hits": bot.prompt_cache.hits,
+            "misses": bot.prompt_cache.misses,
+            "coalesced": bot.metrics.value("llm_requests_total", result="coalesced"),
+        },
+        "outbound": bot.outbound.stats(),
+    }
+
+
+# --- 세션 메모리 ---
+def measure_session_memory(sessions, hands, seed):
+    """긴 슈를 가진 세션 하나가 차지하는 메모리 (tracemalloc 기준, 바이트)"""
+    rng = random.Random(seed)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = []
+    for user_id in range(sessions):
+        session = bot.Session(-1 - user_id)
+        for _ in range(hands):
+            session.record_result(rng.choices("PBT", weights=(45, 46, 9))[0], rng.random() < 0.3)
+        kept.append(session)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {"sessions": sessions, "hands": hands, "bytes_per_session": (after - before) / sessions}
+
+
+# --- 마이크로 벤치마크 ---
+def bench(fn, min_time=0.5, setup=None):
+    """fn 을 min_time 초 이상 반복 실행한 1회 평균 시간(µs)"""
+    runs, elapsed = 0, 0.0
+    while elapsed < min_time:
+        if setup:
+            setup()
+        started = time.perf_counter()
+        fn()
+        elapsed += time.perf_counter() - started
+        runs += 1
+    return elapsed / runs * 1e6
+
+def run_micro(args):
+    rng = random.Random(args.seed)
+    user_id = -999
+    session = bot.session_store.get(user_id)
+    for _ in range(args.micro_hands):
+        session.record_result(rng.choices("PBT", weights=(45, 46, 9))[0], rng.random() < 0.3)
+    session.page = session.road.total_pages - 1
+    road = session.road
+    for outcome in ("win", "loss", "win"):
+        bot.log_result(user_id, "Player", outcome)
+    bot.db_writer.flush()
+
+    def clear_canvases():
+        bot.road_renderer._canvases.clear()
+
+    def add_hand():
+        session.record_result(rng.choice("PB"), False)
+        session.page = session.road.total_pages - 1
+
+    def cold_feedback():
+        bot.feedback_counters._counts.pop(user_id, None)
+
+    results = {
+        "create_big_road_image_full_us": bench(lambda: bot.create_big_road_image(user_id), setup=clear_canvases),
+        "create_big_road_image_incremental_us": bench(lambda: bot.create_big_road_image(user_id), setup=add_hand),
+        # 예전 _get_page_info 는 BigRoad.total_pages / page_columns 로 바뀌었다
+        "page_info_us": bench(lambda: (road.total_pages, road.page_columns(road.total_pages - 1))),
+        "get_feedback_stats_us": bench(lambda: bot.get_feedback_stats(user_id)),
+        "get_feedback_stats_cold_us": bench(lambda: bot.get_feedback_stats(user_id), setup=cold_feedback),
+        "build_caption_text_us": bench(lambda: bot.build_caption_text(user_id)),
+        "big_road_add_us": bench(lambda: road.add(rng.choice("PBT"))),
+    }
+    bot.session_store.reset(user_id)
+    return results
+
+
+# --- 결과 출력 / 비교 ---
+def print_report(results):
+    load = results.get("load")
+    if load:
+        lat = load["handler_latency"]
+        print(f"\n[부하 테스트] 사용자 {load['users']}명 × {load['hands_per_user']}핸드, 업데이트 {load['updates']}건")
+        print(f"  처리량          {load['throughput_updates_per_s']:.1f} updates/s "
+              f"(핸들러 {load['handler_seconds']:.2f}s, 마무리까지 {load['settled_seconds']:.2f}s)")
+        print(f"  핸들러 지연     p50 {lat['p50_ms']:.2f}ms  p95 {lat['p95_ms']:.2f}ms  p99 {lat['p99_ms']:.2f}ms  max {lat['max_ms']:.2f}ms")
+        for name, label in (("render", "이미지 렌더링"), ("db_write_batch", "DB 배치 쓰기")):
+            stat = load[name]
+            if stat["count"]:
+                print(f"  {label:<14}{stat['count']}회, 평균 {stat['mean_ms']:.2f}ms  p95 {stat['p95_ms']:.2f}ms  p99 {stat['p99_ms']:.2f}ms")
+        print(f"  DB 기록 행 수   {load['db_rows']} (버림 {load['db_dropped']})")
+        print(f"  텔레그램 호출   {load['telegram_calls']}")
+        print(f"  OpenAI 호출     {load['openai_calls']}")
+        print(f"  이미지 캐시     {load['render_cache']}")
+        print(f"  추천 캐시       {load.get('prompt_cache')}")
+    memory = results.get("memory")
+    if memory:
+        print(f"\n[세션 메모리] {memory['hands']}핸드 세션당 {memory['bytes_per_session'] / 1024:.1f} KiB")
+    micro = results.get("micro")
+    if micro:
+        print("\n[마이크로 벤치마크] (1회 평균)")
+        for name, value in micro.items():
+            print(f"  {name:<40}{value:>10.1f} µs")
+
+def comparable_metrics(results):
+    """기준값과 비교할 항목 (작을수록 좋은 값만)"""
+    metrics = dict(results.get("micro", {}))
+    load = results.get("load")
+    if load:
+        metrics["handler_p95_ms"] = load["handler_latency"].get("p95_ms", 0.0)
+        metrics["render_p95_ms"] = load["render"].get("p95_ms", 0.0)
+    memory = results.get("memory")
+    if memory:
+        metrics["bytes_per_session"] = memory["bytes_per_session"]
+    return metrics
+
+def compare(results, baseline_path, tolerance):
+    """기준값보다 tolerance 비율 이상 나빠진 항목을 출력하고 개수를 반환"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = comparable_metrics(json.load(f))
+    regressions = 0
+    print(f"\n[기준값 비교] {baseline_path} (허용 {tolerance:.0%})")
+    for name, value in comparable_metrics(results).items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        change = value / base - 1
+        mark = "느려짐" if change > tolerance else "ok"
+        regressions += change > tolerance
+        print(f"  {name:<40}{base:>10.1f} -> {value:>10.1f} ({change:+.0%}) {mark}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="바카라 봇 벤치마크 / 부하 테스트")
+    parser.add_argument("--users", type=int, default=1000, help="가상 사용자 수")
+    parser.add_argument("--hands", type=int, default=200, help="사용자별 슈 길이 (핸드 수)")
+    parser.add_argument("--concurrency", type=int, default=bot.CONCURRENT_UPDATES, help="동시에 처리할 업데이트 수")
+    parser.add_argument("--think", type=float, default=0.0, help="클릭 사이 평균 대기 시간(초)")
+    parser.add_argument("--feedback-rate", type=float, default=0.2, help="핸드당 승/패 피드백 버튼을 누를 확률")
+    parser.add_argument("--mode", choices=sorted(bot.RECOMMENDER_MODES), default="local_then_llm", help="추천 방식")
+    parser.add_argument("--no-auto-analysis", action="store_true", help="결과 입력 시 자동 AI 분석을 끈다")
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="가짜 텔레그램 API 응답 지연(초)")
+    parser.add_argument("--openai-latency", type=float, default=0.5, help="가짜 OpenAI 응답 지연(초)")
+    parser.add_argument("--real-rate-limits", action="store_true", help="텔레그램 발신 속도 제한을 실제 값으로 적용")
+    parser.add_argument("--memory-sessions", type=int, default=500, help="메모리 측정용 세션 수")
+    parser.add_argument("--micro-hands", type=int, default=300, help="마이크로 벤치마크용 슈 길이")
+    parser.add_argument("--micro-only", action="store_true", help="마이크로 벤치마크와 메모리 측정만 실행")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--save", help="결과를 JSON 으로 저장할 경로")
+    parser.add_argument("--compare", help="비교할 기준 결과 JSON 경로")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="허용하는 성능 저하 비율")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix="baccarat-bench-")
+    bot.DB_FILE = os.path.join(workdir, "bench.db")
+    bot.setup_database()
+
+    results = {"config": vars(args)}
+    results["micro"] = run_micro(args)
+    results["memory"] = measure_session_memory(args.memory_sessions, args.hands, args.seed)
+    if not args.micro_only:
+        timings = Timings()
+        timings.install()
+        results["load"] = asyncio.run(run_load(args, timings))
+    bot.db_writer.close()
+
+    print_report(results)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
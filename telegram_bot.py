@@ -20,15 +20,34 @@
 # SQLite 동시접속 write lock 문제 최소화 (WAL 모드/timeout/retry)
 # 최종 서비스 본(25년8월02일 최종수정)
 
+import time
+BOOT_STARTED = time.perf_counter()  # 콜드 스타트 측정 기준 (모듈 import 시작 시각)
+
 import os
+import io
 import asyncio
+import atexit
+import bisect
+import functools
+import hashlib
+import hmac
+import itertools
+import json
 import math
+import multiprocessing
+import queue
+import secrets
+import signal
 import sqlite3
+import sys
 import datetime
-import time
-from collections import defaultdict
-from openai import OpenAI
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+import threading
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qsl, urlsplit
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -36,106 +55,953 @@ from telegram.ext import (
     CallbackQueryHandler,
 )
 from telegram.constants import ParseMode
-from PIL import Image, ImageDraw, ImageFont
+from telegram.error import BadRequest, NetworkError, RetryAfter
 
 # --- 환경설정 ---
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 DB_FILE = "baccarat_stats.db"
 COLS_PER_PAGE = 20
+ROAD_ROWS = 6
+ROAD_CELL_SIZE = 22
+ROAD_TOP_PADDING = 30
+ROAD_BG_COLOR = "#f4f6f9"
+RENDER_CACHE_USERS = int(os.environ.get("RENDER_CACHE_USERS", "256"))
+RENDER_CACHE_BYTES = int(os.environ.get("RENDER_CACHE_BYTES", str(32 * 1024 * 1024)))
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", "5000"))
+SESSION_IDLE_SECONDS = float(os.environ.get("SESSION_IDLE_SECONDS", "1800"))
+SESSION_SWEEP_INTERVAL = 60
+PERFORMANCE_HISTORY_SIZE = 10
+RECOMMENDER_MODES = {"llm": "GPT", "local_then_llm": "로컬+GPT", "local": "로컬"}
+DEFAULT_RECOMMENDER_MODE = os.environ.get("RECOMMENDER_MODE", "llm")
+OPENAI_MODEL = "gpt-4o"
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", "30"))
+OPENAI_MAX_CONCURRENCY = int(os.environ.get("OPENAI_MAX_CONCURRENCY", "8"))
+PROMPT_HISTORY_TOKENS = int(os.environ.get("PROMPT_HISTORY_TOKENS", "200"))  # 프롬프트에 넣는 게임 기록의 토큰 예산
+PROMPT_CACHE_SIZE = int(os.environ.get("PROMPT_CACHE_SIZE", "10000"))
+PROMPT_CACHE_TTL = float(os.environ.get("PROMPT_CACHE_TTL", str(6 * 3600)))  # 0이면 추천 캐시를 쓰지 않음
+DB_BATCH_SIZE = int(os.environ.get("DB_BATCH_SIZE", "200"))
+DB_FLUSH_INTERVAL = float(os.environ.get("DB_FLUSH_INTERVAL", "0.5"))
+DB_QUEUE_MAX = int(os.environ.get("DB_QUEUE_MAX", "10000"))
+DB_QUEUE_PUT_TIMEOUT = 0.05  # 큐가 가득 찼을 때 버리면 안 되는 쓰기가 자리를 기다리며 쓰기 스레드 상태를 확인하는 간격
+UI_DEBOUNCE_SECONDS = float(os.environ.get("UI_DEBOUNCE_SECONDS", "0.3"))
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", "30"))  # 초당 전체 API 호출 수
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", "1"))  # 초당 채팅별 호출 수
+TELEGRAM_CHAT_BURST = 3
+TELEGRAM_MAX_RETRIES = 3
+# 실행 모드: polling(기본) 또는 webhook (webhook 은 내장 HTTP 서버로 업데이트를 받음)
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # 예: https://example.herokuapp.com (없으면 setWebhook 생략)
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")  # 없으면 WEBHOOK_URL 로 setWebhook 할 때 실행마다 새로 만들어 등록
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("PORT", "8443"))
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "32"))
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")  # 로컬 Bot API 서버/테스트용 가짜 서버 주소
+HTTP_MAX_BODY = 1024 * 1024
+# 멀티 프로세스: SHARDS 개의 워커가 user_id 해시로 사용자를 나눠 맡고, DB 쓰기는 전용 프로세스 하나가 담당
+SHARD_COUNT = int(os.environ.get("SHARDS", "1"))
+RENDER_PROCESSES = int(os.environ.get("RENDER_PROCESSES", "0"))  # 워커별 렌더링 프로세스 수 (0이면 이벤트 루프에서 직접)
+HTTP_KEEPALIVE_TIMEOUT = 75
+
+# 계측: METRICS_PORT 가 있으면 /metrics 전용 HTTP 서버, METRICS_FILE 이 있으면 주기적으로 파일에 기록
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_FILE = os.environ.get("METRICS_FILE")
+METRICS_DUMP_INTERVAL = float(os.environ.get("METRICS_DUMP_INTERVAL", "60"))
+# 샘플링 프로파일러: 간격(초)을 주면 켜지고 PROFILE_FILE 에 collapsed stack(flamegraph) 형식으로 기록
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", "0"))
+PROFILE_FILE = os.environ.get("PROFILE_FILE", "profile.folded")
+# 관리자 통계 API: ADMIN_TOKEN 이 있으면 웹훅/메트릭 HTTP 서버에 /admin/* JSON 엔드포인트를 연다
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+ADMIN_PAGE_SIZE = 50
+ADMIN_MAX_PAGE_SIZE = 500
+USER_SEEN_WRITE_INTERVAL = 60  # users.last_seen 을 갱신하는 최소 간격(초)
+# 보관 기간이 지난 activity 원본 행은 DB 쓰기 스레드/프로세스가 activity_archive 로 옮긴다 (0이면 옮기지 않음)
+ACTIVITY_RETENTION_DAYS = float(os.environ.get("ACTIVITY_RETENTION_DAYS", "90"))
+ARCHIVE_INTERVAL = float(os.environ.get("ARCHIVE_INTERVAL", str(6 * 3600)))
+ARCHIVE_BATCH = 5000
 
 # --- 전역 변수 초기화 ---
-client = OpenAI(api_key=OPENAI_API_KEY)
-user_data = {}
-user_locks = defaultdict(asyncio.Lock)
+client = None  # get_openai_client() 가 처음 쓸 때 생성 (openai 패키지 import 가 무거워 부팅에서 뺌)
+_client_lock = threading.Lock()
+openai_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+analysis_tasks = {}  # user_id -> 디바운스 후 AI 분석을 실행하는 작업
+ui_refreshes = {}  # user_id -> [context, query, dirty] (화면 갱신 대기 상태)
+background_tasks = set()
+llm_inflight = {}  # 추천 캐시 키 -> [진행 중인 GPT 호출 작업, 기다리는 요청 수] (같은 키의 동시 요청은 한 번만 호출)
+metrics_server = None
+
+
+# --- 계측 (메트릭 / 프로파일러) ---
+class Metrics:
+    """Prometheus 텍스트 형식으로 내보내는 프로세스 내 메트릭 (카운터, 히스토그램, 게이지)
+    DB 쓰기 스레드에서도 기록하므로 잠금으로 보호한다."""
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, prefix="baccarat_"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._meta = {}  # name -> (type, help)
+        self._counters = {}  # (name, labels) -> 값
+        self._histograms = {}  # (name, labels) -> [구간별 개수..., 합계, 개수]
+        self._gauges = {}  # name -> 현재 값을 돌려주는 함수
+
+    def describe(self, name, kind, help_text):
+        self._meta[name] = (kind, help_text)
+
+    def gauge(self, name, help_text, fn, kind="gauge"):
+        """렌더링할 때 fn() 으로 값을 읽는 메트릭 (다른 객체가 이미 세고 있는 값용)"""
+        self.describe(name, kind, help_text)
+        self._gauges[name] = fn
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [0] * len(self.BUCKETS) + [0.0, 0]
+            i = bisect.bisect_left(self.BUCKETS, value)
+            if i < len(self.BUCKETS):
+                hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def time(self, stage):
+        """with metrics.time("render"): ... 구간의 소요 시간을 stage_seconds 에 기록"""
+        return _StageTimer(self, stage)
+
+    def value(self, name, **labels):
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def render(self):
+        """Prometheus text exposition format (0.0.4)"""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(hist)) for key, hist in self._histograms.items())
+        lines, described = [], set()
+
+        def header(name):
+            if name not in described and name in self._meta:
+                kind, help_text = self._meta[name]
+                lines.append(f"# HELP {self.prefix}{name} {help_text}")
+                lines.append(f"# TYPE {self.prefix}{name} {kind}")
+                described.add(name)
+
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f"{self.prefix}{name}{_format_labels(labels)} {value}")
+        for (name, labels), hist in histograms:
+            header(name)
+            cumulative = 0
+            for le, count in zip(self.BUCKETS, hist):
+                cumulative += count
+                lines.append(f"{self.prefix}{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{self.prefix}{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {hist[-1]}")
+            lines.append(f"{self.prefix}{name}_sum{_format_labels(labels)} {hist[-2]:.6f}")
+            lines.append(f"{self.prefix}{name}_count{_format_labels(labels)} {hist[-1]}")
+        for name, fn in self._gauges.items():
+            try:
+                value = fn()
+            except Exception:
+                continue
+            header(name)
+            lines.append(f"{self.prefix}{name} {value}")
+        return "\n".join(lines) + "\n"
+
+class _StageTimer:
+    __slots__ = ("metrics", "stage", "started")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe("stage_seconds", time.perf_counter() - self.started, stage=self.stage)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in labels) + "}"
+
+def _escape_label(value):
+    """Prometheus 라벨 값 이스케이프 (\\, ", 줄바꿈)"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+# 키보드에 있는 버튼 동작 (콜백 데이터는 클라이언트가 마음대로 보낼 수 있으므로 라벨/집계에는 이 안의 값만 씀)
+BUTTON_ACTIONS = frozenset((
+    "P", "B", "T", "feedback_win", "feedback_loss", "reset", "toggle_auto_analysis", "cycle_mode",
+    "page_next", "page_prev", "analyze",
+))
+
+def action_label(action):
+    """메트릭 라벨/롤업 키로 쓸 버튼 동작 (모르는 값은 'other' 하나로 모음)"""
+    return action if action in BUTTON_ACTIONS else "other"
+
+def timed(stage):
+    """async 함수 전체의 실행 시간을 stage 로 기록하는 데코레이터"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with metrics.time(stage) as timer:
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    if startup.first_update_seconds is None:
+                        startup.record_first_update(stage, time.perf_counter() - timer.started)
+        return wrapper
+    return decorate
+
+metrics = Metrics()
+metrics.describe("stage_seconds", "histogram", "콜백 처리 단계별 소요 시간(초)")
+metrics.describe("clicks_total", "counter", "버튼 클릭 수")
+metrics.describe("clicks_dropped_total", "counter", "처리하지 않고 버린 클릭 수")
+metrics.describe("db_retries_total", "counter", "DB lock 으로 다시 시도한 쓰기 수")
+metrics.describe("db_lock_errors_total", "counter", "재시도 후에도 lock 으로 실패한 쓰기 수")
+metrics.describe("db_rows_written_total", "counter", "DB 에 기록한 행 수")
+metrics.describe("db_write_errors_total", "counter", "lock 이외의 오류로 버린 쓰기 요청 수")
+metrics.describe("db_queue_waits_total", "counter", "대기열이 가득 차 자리가 날 때까지 기다린 쓰기 요청 수")
+metrics.describe("llm_requests_total", "counter", "GPT 호출 수 (결과별)")
+metrics.describe("llm_tokens_total", "counter", "GPT 사용 토큰 수")
+metrics.describe("ui_refresh_coalesced_total", "counter", "디바운스로 합쳐진 화면 갱신 요청 수")
+metrics.describe("analysis_superseded_total", "counter", "새 입력으로 취소된 AI 분석 요청 수")
+metrics.describe("activity_archived_total", "counter", "activity_archive 로 옮긴 activity 행 수")
+metrics.describe("startup_seconds", "gauge", "부팅 단계별 소요 시간(초)")
+metrics.describe("first_update_seconds", "gauge", "부팅 후 첫 업데이트 처리 시간(초)")
+
+# 다른 객체가 이미 세고 있는 값들 (렌더링할 때 읽음)
+metrics.gauge("sessions_cached", "메모리에 있는 세션 수", lambda: len(session_store))
+metrics.gauge("render_cache_hits_total", "이미지 캐시 적중 수", lambda: render_cache.hits, "counter")
+metrics.gauge("render_cache_misses_total", "이미지 캐시 미스 수", lambda: render_cache.misses, "counter")
+metrics.gauge("prompt_cache_hits_total", "GPT 추천 캐시 적중 수", lambda: prompt_cache.hits, "counter")
+metrics.gauge("prompt_cache_misses_total", "GPT 추천 캐시 미스 수", lambda: prompt_cache.misses, "counter")
+metrics.gauge("render_cache_bytes", "이미지 캐시 크기(바이트)", lambda: render_cache.size)
+metrics.gauge("db_queue_depth", "DB 쓰기 대기열 길이", lambda: db_writer.queue.qsize())
+metrics.gauge("db_dropped_total", "대기열이 가득 차 버린 DB 쓰기 수", lambda: db_writer.dropped, "counter")
+metrics.gauge("outbound_queue_depth", "텔레그램 발신 대기열 길이", lambda: outbound.depth)
+metrics.gauge("outbound_sent_total", "텔레그램 API 호출 수", lambda: outbound.sent, "counter")
+metrics.gauge("outbound_coalesced_total", "최신 상태로 대체되어 보내지 않은 수정 수", lambda: outbound.coalesced, "counter")
+metrics.gauge("outbound_retried_total", "재시도한 텔레그램 API 호출 수", lambda: outbound.retried, "counter")
+metrics.gauge("outbound_failed_total", "실패한 텔레그램 API 호출 수", lambda: outbound.failed, "counter")
+metrics.gauge("background_tasks", "진행 중인 분석/화면 갱신 작업 수", lambda: len(background_tasks))
+
+class MetricsDumper:
+    """METRICS_FILE 에 interval 초마다 메트릭을 기록하는 스레드 (node_exporter textfile 수집기 형식)"""
+
+    def __init__(self, path, interval=METRICS_DUMP_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="metrics-dump", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        self.dump()
+
+    def dump(self):
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(metrics.render())
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"메트릭 기록 오류: {e}")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.dump()
+
+class SamplingProfiler:
+    """interval 초마다 모든 스레드의 호출 스택을 찍어 collapsed stack 형식으로 모으는 샘플링 프로파일러
+    결과 파일은 flamegraph.pl / speedscope 로 바로 볼 수 있다."""
+
+    def __init__(self, path, interval, dump_every=30):
+        self.path = path
+        self.interval = interval
+        self.dump_every = dump_every
+        self.samples = {}  # "스레드;모듈:함수:줄;..." -> 횟수
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        self.dump()
+
+    def sample(self):
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            key = ";".join(reversed(stack))
+            self.samples[key] = self.samples.get(key, 0) + 1
+
+    def dump(self):
+        try:
+            with open(self.path, "w", encoding="utf-8") as f:
+                for stack, count in sorted(self.samples.items()):
+                    f.write(f"{stack} {count}\n")
+        except OSError as e:
+            print(f"프로파일 기록 오류: {e}")
+
+    def _run(self):
+        next_dump = time.monotonic() + self.dump_every
+        while not self._stop.wait(self.interval):
+            self.sample()
+            if time.monotonic() >= next_dump:
+                self.dump()
+                next_dump = time.monotonic() + self.dump_every
+
+def start_instrumentation(suffix=""):
+    """환경변수로 켠 메트릭 파일 기록/프로파일러를 시작 (샤드별로 파일 이름에 suffix 를 붙임)"""
+    if METRICS_FILE:
+        root, ext = os.path.splitext(METRICS_FILE)
+        MetricsDumper(root + suffix + ext).start()
+    if PROFILE_SAMPLE_INTERVAL > 0:
+        root, ext = os.path.splitext(PROFILE_FILE)
+        SamplingProfiler(root + suffix + ext, PROFILE_SAMPLE_INTERVAL).start()
 
 
 # --- 데이터베이스 관련 함수 ---
-def get_db_conn():
-    """안전한 SQLite 연결을 반환하는 함수 (WAL 모드 활성화)"""
+_db_local = threading.local()
+
+def open_db_conn():
+    """새 SQLite 연결을 여는 함수 (WAL 모드 활성화)"""
     conn = sqlite3.connect(DB_FILE, timeout=10)
     conn.execute("PRAGMA journal_mode=WAL;")
     return conn
 
-def safe_db_write(query, params=()):
-    """DB 쓰기 작업을 재시도 로직과 함께 안전하게 실행하는 함수"""
+def get_db_conn():
+    """스레드마다 한 번 연 SQLite 연결을 재사용해 반환하는 함수 (매번 connect/PRAGMA 하지 않음)"""
+    cached = getattr(_db_local, "conn", None)
+    if cached is None or cached[0] != DB_FILE:
+        cached = _db_local.conn = (DB_FILE, open_db_conn())
+    return cached[1]
+
+def safe_db_write_many(statements):
+    """여러 쓰기 작업을 한 트랜잭션으로 재시도 로직과 함께 실행하는 함수"""
     retries, delay = 5, 1
     for i in range(retries):
         try:
             with get_db_conn() as conn:
-                conn.execute(query, params)
+                for query, params in statements:
+                    conn.execute(query, params)
                 return
         except sqlite3.OperationalError as e:
             if "locked" in str(e):
+                metrics.inc("db_retries_total", where="direct")
                 time.sleep(delay * (i + 1))
             else:
                 raise
+    metrics.inc("db_lock_errors_total", where="direct")
     raise RuntimeError("DB write lock이 지속적으로 발생하여 작업을 중단합니다.")
 
+class DBWriter:
+    """DB 쓰기 요청을 큐에 모아 전용 스레드가 하나의 연결로 배치 처리하는 write-behind 로거
+    - batch_size 만큼 모이거나 flush_interval 이 지나면 한 트랜잭션으로 executemany
+    - 큐가 가득 차면 droppable 요청(activity 로그)만 버리고 dropped 를 증가,
+      결과/초기화/세션처럼 메모리 상태와 짝이 맞아야 하는 요청은 자리가 날 때까지 기다린다(backpressure)
+    - 샤딩 모드에서는 channel 에 프로세스 간 큐를 넘겨 DB 쓰기 전용 프로세스에서 _run 을 실행
+    - 쓰기 요청 사이사이에 보관 기간이 지난 activity 를 한 배치씩 activity_archive 로 옮긴다 (쓰는 연결은 항상 하나)"""
+    _STOP = None  # 프로세스 간 큐를 거쳐도 동일성이 유지되는 종료 표시
+
+    def __init__(self, batch_size=DB_BATCH_SIZE, flush_interval=DB_FLUSH_INTERVAL, max_queue=DB_QUEUE_MAX,
+                 channel=None, acks=None, archive_interval=ARCHIVE_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = channel if channel is not None else queue.Queue(maxsize=max_queue)
+        self.acks = acks  # 샤드 번호 -> flush 완료를 알릴 프로세스 간 Event
+        self.dropped = 0
+        self.archive_interval = archive_interval if ACTIVITY_RETENTION_DAYS > 0 else 0
+        self._archive_due = time.monotonic()  # 다음 보관 처리 시각 (옮길 행이 남아 있는 동안은 지난 시각 그대로)
+        self._archived = 0
+        self._thread = None
+        self._closed = False
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, query, params=()):
+        """쓰기 요청을 큐에 넣는다 (종료 후에는 즉시 동기 쓰기)"""
+        return self.submit_many([(query, params)])
+
+    def submit_many(self, statements, droppable=False):
+        """여러 쓰기 요청을 같은 트랜잭션에 기록되도록 하나로 묶어 큐에 넣는다
+        droppable 이면 큐가 가득 찼을 때 기다리지 않고 버리고 False 반환"""
+        with metrics.time("db_log"):
+            return self._submit(list(statements), droppable)
+
+    def _submit(self, statements, droppable):
+        if self._closed:
+            safe_db_write_many(statements)
+            return True
+        self.start()
+        try:
+            self.queue.put_nowait(statements)
+            return True
+        except queue.Full:
+            pass
+        if droppable:
+            self.dropped += 1
+            print(f"DB 쓰기 큐가 가득 차 로그를 버립니다. (누적 {self.dropped}건)")
+            return False
+        metrics.inc("db_queue_waits_total")
+        while True:
+            try:
+                self.queue.put(statements, timeout=DB_QUEUE_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                if not self._writer_alive():
+                    # 큐를 비울 쓰기 스레드가 없으면 직접 기록
+                    safe_db_write_many(statements)
+                    return True
+
+    def _writer_alive(self):
+        return not self._closed and self._thread is not None and self._thread.is_alive()
+
+    def flush(self, timeout=5):
+        """지금까지 넣은 요청이 모두 기록될 때까지 기다린다"""
+        if self._thread is None or self._closed or not self._thread.is_alive():
+            return
+        done = threading.Event()
+        try:
+            self.queue.put((None, done), timeout=timeout)
+        except queue.Full:
+            return
+        done.wait(timeout)
+
+    def close(self, timeout=10):
+        """남은 요청을 모두 기록하고 쓰기 스레드를 종료한다"""
+        with self._start_lock:
+            if self._closed:
+                return
+            self._closed = True
+        if self._thread is not None:
+            self.queue.put(self._STOP)
+            self._thread.join(timeout)
+
+    def _run(self):
+        conn = open_db_conn()
+        try:
+            stop = False
+            while not stop:
+                archiving = self.archive_interval and time.monotonic() >= self._archive_due
+                if archiving:
+                    self._archive_step(conn)
+                try:
+                    item = self.queue.get(timeout=0.01 if archiving else 1.0)
+                except queue.Empty:
+                    continue
+                submissions, events = [], []
+                try:
+                    deadline = time.monotonic() + self.flush_interval
+                    rows = 0
+                    while True:
+                        if item is self._STOP:
+                            stop = True
+                            break
+                        if isinstance(item, tuple):  # flush 요청
+                            events.append(item[1])
+                            break
+                        submissions.append(item)
+                        rows += len(item)
+                        remaining = deadline - time.monotonic()
+                        if rows >= self.batch_size or remaining <= 0:
+                            break
+                        try:
+                            item = self.queue.get(timeout=remaining)
+                        except queue.Empty:
+                            break
+                    if stop:
+                        submissions.extend(self._drain(events))
+                    self._write_submissions(conn, submissions)
+                except Exception as e:
+                    # 어떤 오류가 나도 쓰기 스레드는 살아 있어야 flush/close 가 멈추지 않는다
+                    metrics.inc("db_write_errors_total")
+                    print(f"DB 쓰기 스레드 오류로 {len(submissions)}건의 요청을 버립니다: {e!r}")
+                finally:
+                    for event in events:
+                        (self.acks[event] if isinstance(event, int) else event).set()
+        finally:
+            conn.close()
+
+    def _archive_step(self, conn):
+        """보관 기간이 지난 activity 를 ARCHIVE_BATCH 행 옮기고, 더 옮길 것이 없으면 다음 처리를 archive_interval 뒤로 미룬다"""
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=ACTIVITY_RETENTION_DAYS)
+        cutoff = cutoff.strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            moved = archive_activity(conn, cutoff)
+        except Exception as e:
+            print(f"activity 보관 처리 오류: {e!r}")
+            moved = 0
+        self._archived += moved
+        if not moved:
+            self._archive_due = time.monotonic() + self.archive_interval
+            if self._archived:
+                print(f"{cutoff} 이전 activity {self._archived}건을 activity_archive 로 옮겼습니다.")
+            self._archived = 0
+
+    def _drain(self, events):
+        items = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return items
+            if item is self._STOP:
+                continue
+            if isinstance(item, tuple):
+                events.append(item[1])
+            else:
+                items.append(item)
+
+    def _write_submissions(self, conn, submissions):
+        """모은 요청을 한 트랜잭션으로 기록하고, lock 외의 오류가 나면 요청 단위로 나눠 문제 있는 요청만 버린다"""
+        try:
+            self._write_batch(conn, [statement for statements in submissions for statement in statements])
+            return
+        except Exception as e:
+            if len(submissions) == 1:
+                self._reject(submissions[0], e)
+                return
+        for statements in submissions:
+            try:
+                self._write_batch(conn, statements)
+            except Exception as e:
+                self._reject(statements, e)
+
+    def _reject(self, statements, error):
+        metrics.inc("db_write_errors_total")
+        query = " ".join(statements[0][0].split()[:3])
+        print(f"DB 쓰기 오류로 요청 1건({query} ... {len(statements)}개 쿼리)을 버립니다: {error!r}")
+
+    def _write_batch(self, conn, batch):
+        """batch 를 한 트랜잭션으로 기록 (lock 은 재시도, 그 밖의 오류는 호출자에게 전달)"""
+        if not batch:
+            return
+        # 같은 쿼리가 연속된 구간끼리 묶어서 순서를 유지한 채 executemany
+        groups = []
+        for query, params in batch:
+            if groups and groups[-1][0] == query:
+                groups[-1][1].append(params)
+            else:
+                groups.append((query, [params]))
+        retries, delay = 5, 1
+        for i in range(retries):
+            try:
+                with metrics.time("db_write"), conn:
+                    for query, rows in groups:
+                        conn.executemany(query, rows)
+                metrics.inc("db_rows_written_total", len(batch))
+                return
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e):
+                    raise
+                metrics.inc("db_retries_total", where="writer")
+                time.sleep(delay * (i + 1))
+        metrics.inc("db_lock_errors_total", where="writer")
+        print(f"DB write lock이 지속되어 {len(batch)}건의 로그를 기록하지 못했습니다.")
+
+db_writer = DBWriter()
+atexit.register(db_writer.close)
+
+class ShardDBWriter(DBWriter):
+    """샤드 워커용 DBWriter: 쓰기 요청을 DB 쓰기 전용 프로세스의 큐로 보낸다"""
+
+    def __init__(self, channel, shard, ack):
+        super().__init__(channel=channel)
+        self.shard = shard
+        self.ack = ack
+        self._flush_lock = threading.Lock()  # 샤드당 ack 가 하나뿐이라 여러 스레드의 flush 를 한 번에 하나씩
+
+    def start(self):
+        pass
+
+    def _writer_alive(self):
+        return not self._closed
+
+    def flush(self, timeout=5):
+        if self._closed:
+            return
+        with self._flush_lock:
+            self.ack.clear()
+            try:
+                self.queue.put((None, self.shard), timeout=timeout)
+            except queue.Full:
+                return
+            self.ack.wait(timeout)
+
+    def close(self, timeout=10):
+        self.flush(timeout)
+        self._closed = True
+
+def run_db_writer(channel, acks):
+    """DB 쓰기 전용 프로세스: 모든 샤드의 쓰기 요청을 하나의 연결로 배치 기록"""
+    ignore_stop_signals()
+    DBWriter(channel=channel, acks=acks)._run()
+
+SCHEMA_VERSION = 4
+
 def setup_database():
-    """프로그램 시작 시 필요한 모든 DB 테이블을 생성하는 함수"""
+    """프로그램 시작 시 DB 스키마를 최신으로 맞추는 함수 (이미 최신이면 테이블 생성/마이그레이션을 건너뜀)"""
     with get_db_conn() as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < SCHEMA_VERSION:
+            _migrate_database(conn, version)
+        conn.execute("DELETE FROM prompt_cache WHERE created < ?", (time.time() - PROMPT_CACHE_TTL,))
+
+def _migrate_database(conn, version):
+    """필요한 모든 DB 테이블을 만들고 version 이후의 마이그레이션을 적용"""
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, username TEXT, first_seen TEXT, last_seen TEXT)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS activity (activity_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, timestamp TEXT, action TEXT, details TEXT)"
+    )
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS results_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER,
+        recommendation TEXT, outcome TEXT, created DATETIME)"""
+    )
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS resets (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, reset_time DATETIME)"""
+    )
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS sessions (
+        user_id INTEGER PRIMARY KEY, history BLOB, correct BLOB, player_wins INTEGER, banker_wins INTEGER,
+        page INTEGER, auto_analysis INTEGER, recommendation TEXT, rec_bet_on TEXT, rec_at_round INTEGER,
+        updated TEXT)"""
+    )
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS feedback_counters (
+        user_id INTEGER PRIMARY KEY, win_since_reset INTEGER DEFAULT 0, loss_since_reset INTEGER DEFAULT 0,
+        win_total INTEGER DEFAULT 0, loss_total INTEGER DEFAULT 0, last_reset DATETIME)"""
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS prompt_cache (key TEXT PRIMARY KEY, recommendation TEXT, created REAL)"
+    )
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS analytics_rollups (
+        period TEXT, bucket TEXT, metric TEXT, value INTEGER DEFAULT 0, PRIMARY KEY (period, bucket, metric))"""
+    )
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS analytics_active (
+        period TEXT, bucket TEXT, user_id INTEGER, PRIMARY KEY (period, bucket, user_id))"""
+    )
+    conn.execute("CREATE TABLE IF NOT EXISTS activity_archive AS SELECT * FROM activity WHERE 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_results_log_user_created ON results_log (user_id, created)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_resets_user_time ON resets (user_id, reset_time)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_results_log_user_id ON results_log (user_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_activity_user_id ON activity (user_id, activity_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_activity_archive_id ON activity_archive (activity_id)")
+
+    if version < 1:
+        # 마이그레이션 1: 기존 results_log/resets 로부터 승/패 카운터 채우기
         conn.execute(
-            "CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, username TEXT, first_seen TEXT, last_seen TEXT)"
-        )
-        conn.execute(
-            "CREATE TABLE IF NOT EXISTS activity (activity_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, timestamp TEXT, action TEXT, details TEXT)"
+            """INSERT OR REPLACE INTO feedback_counters
+            (user_id, win_since_reset, loss_since_reset, win_total, loss_total, last_reset)
+            SELECT r.user_id,
+                SUM(r.outcome = 'win' AND (lr.reset_time IS NULL OR r.created >= lr.reset_time)),
+                SUM(r.outcome = 'loss' AND (lr.reset_time IS NULL OR r.created >= lr.reset_time)),
+                SUM(r.outcome = 'win'), SUM(r.outcome = 'loss'), lr.reset_time
+            FROM results_log r
+            LEFT JOIN (SELECT user_id, MAX(reset_time) AS reset_time FROM resets GROUP BY user_id) lr
+                ON lr.user_id = r.user_id
+            GROUP BY r.user_id"""
         )
         conn.execute(
-            """CREATE TABLE IF NOT EXISTS results_log (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER,
-            recommendation TEXT, outcome TEXT, created DATETIME)"""
+            """INSERT OR IGNORE INTO feedback_counters (user_id, last_reset)
+            SELECT user_id, MAX(reset_time) FROM resets GROUP BY user_id"""
         )
+        conn.execute("PRAGMA user_version = 1")
+    if version < 2:
+        # 마이그레이션 2: 사용자별 추천 모드
+        conn.execute("ALTER TABLE sessions ADD COLUMN recommender_mode TEXT")
+        conn.execute("PRAGMA user_version = 2")
+    if version < 3:
+        # 마이그레이션 3: GPT 추천 캐시(prompt_cache) 테이블은 위에서 생성
+        conn.execute("PRAGMA user_version = 3")
+    if version < 4:
+        # 마이그레이션 4: 기존 activity/results_log 로부터 사용자 목록과 시간/일 단위 롤업 채우기
         conn.execute(
-            """CREATE TABLE IF NOT EXISTS resets (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, reset_time DATETIME)"""
+            """INSERT OR IGNORE INTO users (user_id, first_seen, last_seen)
+            SELECT user_id, MIN(timestamp), MAX(timestamp) FROM activity GROUP BY user_id"""
         )
+        actions = sorted(BUTTON_ACTIONS)
+        for period, length in ROLLUP_PERIODS:
+            # 버튼 클릭은 action_label() 과 같이 알려진 동작만 따로 세고 나머지는 'other'
+            conn.execute(
+                f"""INSERT OR REPLACE INTO analytics_rollups (period, bucket, metric, value)
+                SELECT ?, substr(timestamp, 1, ?), 'action:' || CASE WHEN action != 'button_click' THEN action
+                    WHEN details IN ({",".join("?" * len(actions))}) THEN details ELSE 'other' END,
+                    COUNT(*)
+                FROM activity GROUP BY 2, 3""",
+                (period, length, *actions),
+            )
+            conn.execute(
+                """INSERT OR REPLACE INTO analytics_rollups (period, bucket, metric, value)
+                SELECT ?, substr(created, 1, ?), 'ai:' || outcome, COUNT(*) FROM results_log GROUP BY 2, 3""",
+                (period, length),
+            )
+            conn.execute(
+                """INSERT OR IGNORE INTO analytics_active (period, bucket, user_id)
+                SELECT DISTINCT ?, substr(timestamp, 1, ?), user_id FROM activity""",
+                (period, length),
+            )
+        conn.execute("PRAGMA user_version = 4")
 
-def log_activity(user_id, action, details=""):
-    dt = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    safe_db_write(
-        "INSERT INTO activity (user_id, timestamp, action, details) VALUES (?, ?, ?, ?)",
-        (user_id, dt, action, details),
-    )
+def log_activity(user_id, action, details="", username=None):
+    now = datetime.datetime.now()
+    rollups = analytics.record_activity(user_id, action, details, now, username)
+    # activity 행과 그 롤업만 있으면 큐가 가득 찼을 때 버려도 되지만,
+    # 메모리의 마지막 기록(_seen)을 반영한 users/활성 사용자 갱신이 섞이면 버리지 않는다
+    db_writer.submit_many([
+        (
+            "INSERT INTO activity (user_id, timestamp, action, details) VALUES (?, ?, ?, ?)",
+            (user_id, now.strftime("%Y-%m-%d %H:%M:%S"), action, details),
+        ),
+        *rollups,
+    ], droppable=len(rollups) == 1)
 
 def log_result(user_id, recommendation, outcome):
     dt = datetime.datetime.now()
-    safe_db_write(
-        "INSERT INTO results_log (user_id, recommendation, outcome, created) VALUES (?, ?, ?, ?)",
-        (user_id, recommendation, outcome, dt),
-    )
+    db_writer.submit_many([
+        (
+            "INSERT INTO results_log (user_id, recommendation, outcome, created) VALUES (?, ?, ?, ?)",
+            (user_id, recommendation, outcome, dt),
+        ),
+        feedback_counters.record(user_id, outcome),
+        analytics.record_result(outcome, dt),
+    ])
+    recent_results.append(user_id, recommendation, outcome)
 
 def log_reset(user_id):
     dt = datetime.datetime.now()
-    safe_db_write(
-        "INSERT INTO resets (user_id, reset_time) VALUES (?, ?)", (user_id, dt)
+    db_writer.submit_many([
+        ("INSERT INTO resets (user_id, reset_time) VALUES (?, ?)", (user_id, dt)),
+        feedback_counters.reset(user_id, dt),
+    ])
+
+class FeedbackCounters:
+    """사용자별 AI 승/패 카운터 (초기화 이후 / 누적)
+    메모리에 캐시하고, 변경은 feedback_counters 테이블에 로그 INSERT 와 같은 트랜잭션으로 반영한다."""
+
+    def __init__(self, max_users=SESSION_CACHE_SIZE):
+        self.max_users = max_users
+        self._counts = OrderedDict()  # user_id -> [win, loss, win_total, loss_total]
+
+    def __contains__(self, user_id):
+        return user_id in self._counts
+
+    def get(self, user_id):
+        counts = self._counts.get(user_id)
+        if counts is None:
+            db_writer.flush()
+            counts = self.remember(user_id, self._load(user_id))
+        else:
+            self._counts.move_to_end(user_id)
+        return counts
+
+    def remember(self, user_id, counts):
+        """DB에서 읽은 카운터를 캐시에 넣는다 (그 사이 캐시에 들어온 값이 있으면 그것을 유지)"""
+        counts = self._counts.setdefault(user_id, counts)
+        while len(self._counts) > self.max_users:
+            self._counts.popitem(last=False)
+        return counts
+
+    def _load(self, user_id):
+        with get_db_conn() as conn:
+            row = conn.execute(
+                "SELECT win_since_reset, loss_since_reset, win_total, loss_total FROM feedback_counters WHERE user_id=?",
+                (user_id,),
+            ).fetchone()
+        return list(row) if row else [0, 0, 0, 0]
+
+    def record(self, user_id, outcome):
+        """카운터를 1 올리고, DB에 반영할 (query, params)를 반환"""
+        win, loss = int(outcome == "win"), int(outcome == "loss")
+        counts = self.get(user_id)
+        counts[0] += win
+        counts[1] += loss
+        counts[2] += win
+        counts[3] += loss
+        return (
+            """INSERT INTO feedback_counters (user_id, win_since_reset, loss_since_reset, win_total, loss_total)
+            VALUES (?, ?, ?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET
+            win_since_reset = win_since_reset + excluded.win_since_reset,
+            loss_since_reset = loss_since_reset + excluded.loss_since_reset,
+            win_total = win_total + excluded.win_total, loss_total = loss_total + excluded.loss_total""",
+            (user_id, win, loss, win, loss),
+        )
+
+    def reset(self, user_id, reset_time):
+        """초기화 이후 카운터를 0으로 만들고, DB에 반영할 (query, params)를 반환"""
+        counts = self.get(user_id)
+        counts[0] = counts[1] = 0
+        return (
+            """INSERT INTO feedback_counters (user_id, last_reset) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET
+            win_since_reset = 0, loss_since_reset = 0, last_reset = excluded.last_reset""",
+            (user_id, reset_time),
+        )
+
+feedback_counters = FeedbackCounters()
+
+class RecentResults:
+    """사용자별 최근 AI 추천 결과를 담는 링버퍼(deque) 캐시
+    캐시에 없을 때만 results_log 에서 최근 size 건을 인덱스로 조회한다."""
+
+    def __init__(self, size=PERFORMANCE_HISTORY_SIZE, max_users=SESSION_CACHE_SIZE):
+        self.size = size
+        self.max_users = max_users
+        self._buffers = OrderedDict()  # user_id -> deque[(recommendation, outcome)]
+
+    def __contains__(self, user_id):
+        return user_id in self._buffers
+
+    def get(self, user_id):
+        """오래된 것부터 최근 size 건의 (recommendation, outcome) 목록"""
+        buffer = self._buffers.get(user_id)
+        if buffer is None:
+            db_writer.flush()
+            buffer = self.remember(user_id, self._load(user_id))
+        else:
+            self._buffers.move_to_end(user_id)
+        return list(buffer)
+
+    def remember(self, user_id, rows):
+        """DB에서 읽은 결과를 캐시에 넣는다 (그 사이 캐시에 들어온 값이 있으면 그것을 유지)"""
+        buffer = self._buffers.get(user_id)
+        if buffer is None:
+            buffer = self._buffers[user_id] = deque(rows, maxlen=self.size)
+            while len(self._buffers) > self.max_users:
+                self._buffers.popitem(last=False)
+        return buffer
+
+    def append(self, user_id, recommendation, outcome):
+        buffer = self._buffers.get(user_id)
+        if buffer is not None:
+            buffer.append((recommendation, outcome))
+
+    def _load(self, user_id):
+        with get_db_conn() as conn:
+            rows = conn.execute(
+                "SELECT recommendation, outcome FROM results_log WHERE user_id=? ORDER BY id DESC LIMIT ?",
+                (user_id, self.size),
+            ).fetchall()
+        return rows[::-1]
+
+recent_results = RecentResults()
+
+ROLLUP_PERIODS = (("hour", 13), ("day", 10))  # 롤업 단위와 타임스탬프 앞부분 길이 ("YYYY-MM-DD HH" / "YYYY-MM-DD")
+
+class AnalyticsRollups:
+    """관리자 통계용 사용자 목록과 시간/일 단위 롤업을 쓰기 경로에서 갱신
+    로그 INSERT 와 같은 트랜잭션에 들어갈 (query, params) 를 만들어 주며,
+    활성 사용자 집합(analytics_active)과 users.last_seen 은 바뀔 때만 쓰도록 사용자별 마지막 기록을 메모리에 둔다."""
+    ROLLUP_UPSERT = (
+        """INSERT INTO analytics_rollups (period, bucket, metric, value) VALUES (?, ?, ?, 1), (?, ?, ?, 1)
+        ON CONFLICT(period, bucket, metric) DO UPDATE SET value = value + excluded.value"""
     )
 
+    def __init__(self, max_users=SESSION_CACHE_SIZE):
+        self.max_users = max_users
+        self._seen = OrderedDict()  # user_id -> [마지막 활성 시간 버킷, users 를 갱신한 시각]
+
+    def record_activity(self, user_id, action, details, now, username=None):
+        """activity 한 건에 대한 사용자/롤업 갱신 (query, params) 목록"""
+        timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
+        statements = [self._rollup(timestamp, f"action:{action_label(details) if action == 'button_click' else action}")]
+
+        seen = self._seen.pop(user_id, None)
+        self._seen[user_id] = seen = seen or [None, None]
+        while len(self._seen) > self.max_users:
+            self._seen.popitem(last=False)
+        hour = timestamp[:ROLLUP_PERIODS[0][1]]
+        if seen[0] != hour:  # 이 시간 버킷에서 처음 본 사용자만 활성 사용자 집합에 넣음
+            seen[0] = hour
+            params = ()
+            for period, length in ROLLUP_PERIODS:
+                params += (period, timestamp[:length], user_id)
+            statements.append((
+                "INSERT OR IGNORE INTO analytics_active (period, bucket, user_id) VALUES (?, ?, ?), (?, ?, ?)", params
+            ))
+        clock = time.monotonic()
+        if seen[1] is None or clock - seen[1] >= USER_SEEN_WRITE_INTERVAL:
+            seen[1] = clock
+            statements.append((
+                """INSERT INTO users (user_id, username, first_seen, last_seen) VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                username = COALESCE(excluded.username, username), last_seen = excluded.last_seen""",
+                (user_id, username, timestamp, timestamp),
+            ))
+        return statements
+
+    def record_result(self, outcome, created):
+        """AI 추천 결과 한 건에 대한 롤업 갱신 (query, params)"""
+        return self._rollup(created.strftime("%Y-%m-%d %H:%M:%S"), f"ai:{outcome}")
+
+    def _rollup(self, timestamp, metric):
+        params = ()
+        for period, length in ROLLUP_PERIODS:
+            params += (period, timestamp[:length], metric)
+        return self.ROLLUP_UPSERT, params
+
+analytics = AnalyticsRollups()
+
+def archive_activity(conn, cutoff, batch=ARCHIVE_BATCH):
+    """cutoff("YYYY-MM-DD HH:MM:SS") 이전의 activity 행을 activity_id 순서로 최대 batch 행 옮기고 옮긴 행 수를 반환
+    DB 쓰기 스레드/프로세스가 자기 연결로 쓰기 배치 사이에 호출해 짧은 트랜잭션 하나로 끝낸다."""
+    last_id = conn.execute(
+        """SELECT MAX(activity_id) FROM (SELECT activity_id, timestamp FROM activity ORDER BY activity_id LIMIT ?)
+        WHERE timestamp < ?""",
+        (batch, cutoff),
+    ).fetchone()[0]
+    if last_id is None:
+        return 0
+    with conn:
+        conn.execute("INSERT INTO activity_archive SELECT * FROM activity WHERE activity_id <= ?", (last_id,))
+        count = conn.execute("DELETE FROM activity WHERE activity_id <= ?", (last_id,)).rowcount
+    metrics.inc("activity_archived_total", count)
+    return count
+
 def get_feedback_stats(user_id):
-    """초기화 시점 이후의 승/패 통계를 가져오는 함수"""
-    with get_db_conn() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT reset_time FROM resets WHERE user_id=? ORDER BY reset_time DESC LIMIT 1",
-            (user_id,),
-        )
-        row = cursor.fetchone()
-        last_reset = row[0] if row else None
-
-        query = "SELECT outcome, COUNT(*) FROM results_log WHERE user_id=? "
-        params = [user_id]
-        if last_reset:
-            query += "AND created >= ? "
-            params.append(last_reset)
-        query += "GROUP BY outcome"
-        
-        cursor.execute(query, tuple(params))
-        
-        stats = {"win": 0, "loss": 0}
-        for outcome, count in cursor.fetchall():
-            if outcome in ["win", "loss"]:
-                stats[outcome] = count
-    return stats
+    """초기화 시점 이후(win/loss)와 누적(win_total/loss_total) 승/패 통계를 가져오는 함수"""
+    win, loss, win_total, loss_total = feedback_counters.get(user_id)
+    return {"win": win, "loss": loss, "win_total": win_total, "loss_total": loss_total}
 
 
 # --- 유틸리티 및 이미지 생성 함수 ---
@@ -143,158 +1009,869 @@ def escape_markdown(text: str) -> str:
     escape_chars = r"_*[]()~`>#+-.=|{}!"
     return "".join(f"\\{char}" if char in escape_chars else char for char in text)
 
-def _get_page_info(history):
-    if not history:
-        return -1, 1
-    last_col = -1
-    last_winner = None
-    for winner in history:
-        if winner == "T": continue
-        if winner != last_winner:
-            last_col += 1
-        last_winner = winner
-    total_cols = last_col + 1
-    total_pages = math.ceil(total_cols / COLS_PER_PAGE) if COLS_PER_PAGE > 0 else 1
-    return last_col, max(1, total_pages)
+class BigRoad:
+    """빅로드 배치 상태를 결과 1건당 O(1)로 갱신하는 객체
+    칸 상태는 열 우선으로 이어 붙인 bytearray 두 개에 담는다 (세션마다 칸별 리스트를 두지 않도록).
+    cells[c * rows + r] 는 0(빈 칸) 또는 승자 코드(1=P, 2=B)에 적중이면 CORRECT 를 더한 값이고,
+    ties 는 같은 위치의 타이 수(255에서 멈춤)이다. 열 수에 제한이 없다."""
+    __slots__ = ("rows", "cells", "ties", "correct", "pb_count", "last_winner", "last_pos", "digest")
+    CODES = {"P": 1, "B": 2}
+    CORRECT = 4
 
-# --- 빅로드 이미지 생성 ---
-def create_big_road_image(user_id):
-    data = user_data.get(user_id, {})
-    history = data.get("history", [])
-    page = data.get("page", 0)
-    correct_indices = data.get("correct_indices", [])
-
-    cell_size, rows, full_grid_cols = 22, 6, 120
-    full_grid = [[""] * full_grid_cols for _ in range(rows)]
-    last_positions = {}
-    pb_history_index = -1
-    col, row = -1, 0
-
-    if history:
-        last_winner = None
-        for i, winner in enumerate(history):
-            if winner == "T":
-                if last_winner and last_winner in last_positions:
-                    r_pos, c_pos = last_positions[last_winner]
-                    if c_pos < full_grid_cols and full_grid[r_pos][c_pos]:
-                        full_grid[r_pos][c_pos] += "T"
+    def __init__(self, rows=ROAD_ROWS):
+        self.rows = rows
+        self.cells = bytearray()
+        self.ties = bytearray()
+        self.correct = array("I")  # AI 적중으로 채워진 구슬의 P/B 순번 (오름차순)
+        self.pb_count = 0
+        self.last_winner = None
+        self.last_pos = None  # 마지막 P/B 구슬의 (row, col)
+        self.digest = b""  # 기록+적중 여부의 누적 해시 (이미지 캐시 키)
+
+    @classmethod
+    def from_history(cls, history, correct_indices=(), rows=ROAD_ROWS):
+        """'PBT' 문자열(또는 목록) 기록으로부터 빅로드를 다시 만든다"""
+        road = cls(rows)
+        correct_indices = set(correct_indices)
+        for winner in history:
+            road.add(winner, correct=winner != "T" and road.pb_count in correct_indices)
+        return road
+
+    def add(self, winner, correct=False):
+        """결과 하나를 반영하고 표시된 칸의 (row, col)을 반환"""
+        mark = winner + ("C" if correct and winner != "T" else "")
+        self.digest = hashlib.blake2b(self.digest + mark.encode(), digest_size=16).digest()
+        if winner == "T":
+            if self.last_pos:
+                r, c = self.last_pos
+                i = c * self.rows + r
+                self.ties[i] = min(self.ties[i] + 1, 255)
+            return self.last_pos
+
+        if self.last_pos is None:
+            row, col = 0, 0
+        elif winner != self.last_winner:
+            row, col = 0, self.last_pos[1] + 1
+        else:
+            row, col = self.last_pos[0] + 1, self.last_pos[1]
+            if row >= self.rows:  # 6줄을 넘으면 옆으로 꺾어서 이어감
+                row, col = self.rows - 1, col + 1
+        if col >= self.column_count:
+            self.cells += bytes(self.rows)
+            self.ties += bytes(self.rows)
+
+        self.cells[col * self.rows + row] = self.CODES[winner] | (self.CORRECT if correct else 0)
+        if correct:
+            self.correct.append(self.pb_count)
+        self.pb_count += 1
+        self.last_winner = winner
+        self.last_pos = (row, col)
+        return self.last_pos
+
+    @property
+    def column_count(self):
+        return len(self.cells) // self.rows
+
+    @property
+    def total_pages(self):
+        return max(1, math.ceil(self.column_count / COLS_PER_PAGE))
+
+    def cell(self, col, row):
+        """(승자, 적중 여부, 타이 수) 또는 None"""
+        i = col * self.rows + row
+        code = self.cells[i] if i < len(self.cells) else 0
+        if not code:
+            return None
+        return ("P" if code & 1 else "B", bool(code & self.CORRECT), self.ties[i])
+
+    def page_columns(self, page):
+        """해당 페이지에 표시할 열 목록 (빈 열 포함, 항상 COLS_PER_PAGE 개, 칸은 cell() 의 튜플)"""
+        start = page * COLS_PER_PAGE
+        return [[self.cell(c, r) for r in range(self.rows)] for c in range(start, start + COLS_PER_PAGE)]
+
+# --- 로컬 패턴 분석 엔진 ---
+RESULT_NAMES = {"P": "Player", "B": "Banker"}
+
+class PatternEngine:
+    """P/B 결과가 들어올 때마다 패턴 특징을 O(1)로 갱신하는 로컬 분석 엔진
+    연속(streak) 길이, 전환(chop) 비율, 파생 로드(Big Eye Boy/Small Road/Cockroach Pig),
+    n-gram 전이 빈도를 계산하며, 프롬프트의 베팅 지침을 규칙으로 옮긴 추천을 즉시 낸다.
+    세션마다 상주하므로 전체 기록에 비례하는 것은 runs 뿐이고, 나머지는 고정 크기 배열/최근 구간만 둔다."""
+    __slots__ = ("runs", "tail", "pb_count", "switches", "recent", "longest", "derived", "ngrams")
+    NGRAM_MAX = 3
+    RECENT_WINDOW = 12
+    LONG_STREAK = 5
+    DERIVED_ROADS = (("Big Eye Boy", 1), ("Small Road", 2), ("Cockroach Pig", 3))
+
+    def __init__(self):
+        self.runs = array("I")  # 빅로드 논리 열(연속 구간)별 길이 ("H" 는 65,535연속에서 넘친다)
+        self.tail = ""  # 최근 NGRAM_MAX 개 결과
+        self.pb_count = 0
+        self.switches = 0
+        self.recent = bytearray()  # 최근 RECENT_WINDOW 개 결과가 전환(1)인지 연속(0)인지
+        self.longest = array("I", (0, 0))  # Player / Banker 최장 연속
+        self.derived = [bytearray() for _ in self.DERIVED_ROADS]  # 최근 RECENT_WINDOW 개의 b"R"(규칙적) / b"B"(불규칙)
+        self.ngrams = array("I", bytes(4 * 2 * len(NGRAM_INDEX)))  # n-gram 별 [다음 P 횟수, 다음 B 횟수]
+
+    @classmethod
+    def from_history(cls, history):
+        engine = cls()
+        for winner in history:
+            engine.add(winner)
+        return engine
+
+    def ngram_counts(self, gram):
+        """gram 다음에 나온 (Player 횟수, Banker 횟수)"""
+        i = NGRAM_INDEX[gram]
+        return self.ngrams[i], self.ngrams[i + 1]
+
+    def add(self, winner):
+        if winner not in RESULT_NAMES:
+            return
+        for n in range(1, len(self.tail) + 1):
+            self.ngrams[NGRAM_INDEX[self.tail[-n:]] + (winner == "B")] += 1
+
+        if self.tail[-1:] == winner:
+            self.runs[-1] += 1
+            self.recent.append(0)
+        else:
+            if self.tail:
+                self.switches += 1
+                self.recent.append(1)
+            self.runs.append(1)
+        del self.recent[:-self.RECENT_WINDOW]
+        self.pb_count += 1
+        self.tail = (self.tail + winner)[-self.NGRAM_MAX:]
+        side = winner == "B"
+        self.longest[side] = max(self.longest[side], self.runs[-1])
+
+        col, row = len(self.runs) - 1, self.runs[-1] - 1
+        for road, (_, offset) in zip(self.derived, self.DERIVED_ROADS):
+            mark = self._derived_mark(col, row, offset)
+            if mark:
+                road += mark
+                del road[:-self.RECENT_WINDOW]
+
+    def _derived_mark(self, col, row, offset):
+        """빅로드 (col, row) 에 구슬이 놓일 때 파생 로드에 찍히는 표시 (시작 전이면 None)"""
+        runs = self.runs
+        if row == 0:
+            if col - offset - 1 < 0:
+                return None
+            return b"R" if runs[col - 1] == runs[col - 1 - offset] else b"B"
+        if col - offset < 0:
+            return None
+        length = runs[col - offset]
+        return b"B" if row == length else b"R"
+
+    def predicted_marks(self, winner):
+        """다음 결과가 winner 일 때 세 파생 로드에 찍힐 표시 (빅로드 하단 예측과 같은 방식)"""
+        if self.tail[-1:] == winner:
+            col, row = len(self.runs) - 1, self.runs[-1]
+        else:
+            col, row = len(self.runs), 0
+        return [self._derived_mark(col, row, offset) for _, offset in self.DERIVED_ROADS]
+
+    @property
+    def chop_ratio(self):
+        return self.switches / (self.pb_count - 1) if self.pb_count > 1 else 0.0
+
+    @property
+    def recent_chop_ratio(self):
+        return sum(self.recent) / len(self.recent) if self.recent else 0.0
+
+    def recommend(self):
+        """지침 기반 로컬 추천 ('Player' / 'Banker')"""
+        if not self.pb_count:
+            return "Banker"
+        last = self.tail[-1]
+        opposite = "B" if last == "P" else "P"
+        if self.runs[-1] >= self.LONG_STREAK:  # 장줄이면 반대 결과를 우선
+            return RESULT_NAMES[opposite]
+
+        score = 0.0  # 양수면 Player, 음수면 Banker
+        for n in range(len(self.tail), 0, -1):  # 근거가 있는 가장 긴 n-gram 사용
+            p, b = self.ngram_counts(self.tail[-n:])
+            if p + b >= 2:
+                score += (p - b) / (p + b)
+                break
+        if self.recent:  # 최근 흐름이 퐁당이면 반대, 연속이면 같은 쪽
+            direction = 1 if opposite == "P" else -1
+            score += (self.recent_chop_ratio - 0.5) * 2 * direction
+        reds = {w: self.predicted_marks(w).count(b"R") for w in RESULT_NAMES}
+        score += (reds["P"] - reds["B"]) * 0.25
+
+        if score > 0: return "Player"
+        if score < 0: return "Banker"
+        return RESULT_NAMES[opposite]  # 판단이 어려우면 단순 따라가기 대신 반대
+
+    def describe(self):
+        """프롬프트에 넣을 특징 요약"""
+        if not self.pb_count:
+            return "분석할 P/B 결과가 없습니다."
+        lines = [
+            f"- 현재 연속: {RESULT_NAMES[self.tail[-1]]} {self.runs[-1]}연속 "
+            f"(최장 Player {self.longest[0]}, Banker {self.longest[1]})",
+            f"- 전환(chop) 비율: 전체 {self.chop_ratio:.2f}, 최근 {len(self.recent)}회 {self.recent_chop_ratio:.2f}",
+        ]
+        for road, (name, _) in zip(self.derived, self.DERIVED_ROADS):
+            lines.append(f"- {name} 최근: {road.decode() or '-'} (R=규칙, B=불규칙)")
+        for n in range(len(self.tail), 0, -1):
+            p, b = self.ngram_counts(self.tail[-n:])
+            if p + b:
+                lines.append(f"- 직전 '{self.tail[-n:]}' 이후 결과 빈도: Player {p}, Banker {b}")
+                break
+        lines.append(f"- 로컬 엔진 추천: {self.recommend()}")
+        return "\n".join(lines)
+
+# 길이 1~NGRAM_MAX 의 P/B n-gram -> PatternEngine.ngrams 배열에서 [다음 P 횟수] 의 위치 (모든 세션이 공유)
+NGRAM_INDEX = {
+    "".join(gram): 2 * i
+    for i, gram in enumerate(
+        gram for n in range(1, PatternEngine.NGRAM_MAX + 1) for gram in itertools.product("PB", repeat=n)
+    )
+}
+
+# --- 세션 저장소 ---
+class Session:
+    """사용자 세션 상태 (__slots__ 사용, 게임 기록은 b"PBT" 코드의 bytearray 로 보관)"""
+    __slots__ = (
+        "user_id", "history", "player_wins", "banker_wins", "recommendation", "recommendation_info",
+        "page", "road", "patterns", "auto_analysis_enabled", "recommender_mode", "shown", "last_access",
+    )
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.shown = None  # (message_id, 이미지 키, 캡션 해시, 키보드 해시)
+        self.last_access = time.monotonic()
+        self.recommender_mode = DEFAULT_RECOMMENDER_MODE
+        self.reset()
+
+    def reset(self):
+        self.history = bytearray()
+        self.player_wins, self.banker_wins = 0, 0
+        self.recommendation = None
+        self.recommendation_info = None
+        self.page = 0
+        self.road = BigRoad()
+        self.patterns = PatternEngine()
+        self.auto_analysis_enabled = False
+
+    @property
+    def history_text(self):
+        return self.history.decode()
+
+    def record_result(self, winner, correct=False):
+        """게임 기록, 승리 카운터, 빅로드를 함께 갱신"""
+        self.history.append(ord(winner))
+        if winner == "P": self.player_wins += 1
+        elif winner == "B": self.banker_wins += 1
+        self.road.add(winner, correct)
+        self.patterns.add(winner)
+
+    def to_row(self):
+        rec_info = self.recommendation_info or {}
+        return (
+            self.user_id, bytes(self.history), self.road.correct.tobytes(),
+            self.player_wins, self.banker_wins, self.page, int(self.auto_analysis_enabled),
+            self.recommendation, rec_info.get("bet_on"), rec_info.get("at_round"),
+            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), self.recommender_mode,
+        )
+
+    @classmethod
+    def from_row(cls, row):
+        (user_id, history, correct, player_wins, banker_wins, page, auto_analysis,
+         recommendation, rec_bet_on, rec_at_round, recommender_mode) = row
+        session = cls(user_id)
+        session.history = bytearray(history or b"")
+        session.road = BigRoad.from_history(session.history_text, array("I", correct or b""))
+        session.patterns = PatternEngine.from_history(session.history_text)
+        session.player_wins, session.banker_wins = player_wins or 0, banker_wins or 0
+        session.page = min(page or 0, session.road.total_pages - 1)
+        session.auto_analysis_enabled = bool(auto_analysis)
+        session.recommendation = recommendation
+        if rec_bet_on:
+            session.recommendation_info = {"bet_on": rec_bet_on, "at_round": rec_at_round}
+        if recommender_mode in RECOMMENDER_MODES:
+            session.recommender_mode = recommender_mode
+        return session
+
+class SessionStore:
+    """최근 사용한 세션만 메모리에 두는 LRU 세션 저장소
+    변경된 세션은 write-behind 로 sessions 테이블에 저장되고, 메모리에서 밀려난(오래 쉬었거나 개수 초과)
+    세션은 다음 콜백이 들어올 때 DB에서 다시 불러온다. 쉬고 있는 사용자의 asyncio.Lock 도 함께 정리한다."""
+
+    def __init__(self, max_sessions=SESSION_CACHE_SIZE, idle_seconds=SESSION_IDLE_SECONDS):
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self._sessions = OrderedDict()
+        self._locks = {}
+        self._last_sweep = time.monotonic()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, user_id):
+        return user_id in self._sessions
+
+    def peek(self, user_id):
+        """메모리에 있는 세션만 반환 (DB 조회 없음)"""
+        return self._sessions.get(user_id)
+
+    def get(self, user_id):
+        """세션을 반환 (메모리에 없으면 DB에서 불러오거나 새로 만든다)"""
+        session = self._sessions.get(user_id)
+        if session is None:
+            db_writer.flush()
+            session = self.remember(user_id, self._load(user_id))
+        else:
+            self._sessions.move_to_end(user_id)
+        session.last_access = time.monotonic()
+        self._evict()
+        return session
+
+    def remember(self, user_id, session):
+        """DB에서 읽은 세션(없으면 None)을 캐시에 넣는다 (그 사이 캐시에 들어온 세션이 있으면 그것을 유지)"""
+        cached = self._sessions.get(user_id)
+        if cached is None:
+            cached = self._sessions[user_id] = session or Session(user_id)
+        return cached
+
+    def reset(self, user_id):
+        session = self.get(user_id)
+        session.reset()
+        self.save(session)
+        return session
+
+    def save(self, session):
+        db_writer.submit(
+            """INSERT OR REPLACE INTO sessions (user_id, history, correct, player_wins, banker_wins, page,
+            auto_analysis, recommendation, rec_bet_on, rec_at_round, updated, recommender_mode)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            session.to_row(),
+        )
+
+    def lock(self, user_id):
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        return lock
+
+    def _load(self, user_id):
+        with get_db_conn() as conn:
+            row = conn.execute(
+                """SELECT user_id, history, correct, player_wins, banker_wins, page, auto_analysis,
+                recommendation, rec_bet_on, rec_at_round, recommender_mode FROM sessions WHERE user_id=?""",
+                (user_id,),
+            ).fetchone()
+        return Session.from_row(row) if row else None
+
+    def _evict(self):
+        now = time.monotonic()
+        sweep = now - self._last_sweep >= SESSION_SWEEP_INTERVAL
+        if sweep:
+            self._last_sweep = now
+        for _ in range(len(self._sessions)):
+            user_id, session = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and not (sweep and now - session.last_access > self.idle_seconds):
+                break
+            lock = self._locks.get(user_id)
+            if lock and lock.locked():
+                self._sessions.move_to_end(user_id)
                 continue
-            
-            pb_history_index += 1
-            if winner != last_winner:
-                col += 1
-                row = 0
+            del self._sessions[user_id]
+            self._locks.pop(user_id, None)
+
+session_store = SessionStore()
+
+async def preload_user(user_id):
+    """핸들러 시작 시 메모리에 없는 사용자 상태를 워커 스레드에서 미리 불러온다
+    대기 중인 쓰기를 flush 한 뒤 읽으므로 방금 쓴 값도 보이고, 이후 동기 get() 은 메모리에서 바로 반환된다."""
+    caches = [cache for cache in (session_store, feedback_counters, recent_results) if user_id not in cache]
+    if not caches:
+        return
+
+    def load():
+        db_writer.flush()
+        return [cache._load(user_id) for cache in caches]
+
+    with metrics.time("preload"):
+        loaded = await asyncio.to_thread(load)
+    for cache, value in zip(caches, loaded):
+        cache.remember(user_id, value)
+
+# --- 빅로드 이미지 생성 ---
+class RoadRenderer:
+    """빅로드 이미지를 디스크 없이 메모리에서 그리는 렌더러
+    폰트, 빈 격자, 구슬 스프라이트(P/B × 빈/채움 × 타이)는 한 번만 만들고,
+    사용자별 페이지 캔버스를 캐시해 바뀐 칸만 스프라이트로 다시 붙인다."""
+
+    def __init__(self, max_canvases=RENDER_CACHE_USERS):
+        self.cell_size = ROAD_CELL_SIZE
+        self.rows = ROAD_ROWS
+        self.top_padding = ROAD_TOP_PADDING
+        self.width = COLS_PER_PAGE * self.cell_size
+        self.height = self.rows * self.cell_size + self.top_padding
+        self.max_canvases = max_canvases
+        self.font = None
+        self.base = None
+        self.sprites = None
+        self._assets_lock = threading.Lock()  # 부팅 시 백그라운드 준비와 첫 렌더링이 겹칠 수 있음
+        self._canvases = OrderedDict()  # user_id -> [page, title, cells, image]
+
+    def load_assets(self):
+        """폰트/스프라이트/빈 격자 이미지를 준비 (최초 1회, Pillow import 도 이때 함)"""
+        if self.base is not None:
+            return
+        with self._assets_lock:
+            if self.base is not None:
+                return
+            from PIL import Image, ImageFont
+            try:
+                self.font = ImageFont.truetype("arial.ttf", 16)
+            except IOError:
+                self.font = ImageFont.load_default()
+
+            keys = [None] + [(w, c, t) for w in "PB" for c in (False, True) for t in (False, True)]
+            self.sprites = {key: self._draw_tile(key) for key in keys}
+            base = Image.new("RGB", (self.width, self.height), color=ROAD_BG_COLOR)
+            for r in range(self.rows):
+                for c in range(COLS_PER_PAGE):
+                    base.paste(self.sprites[None], self._cell_origin(r, c))
+            self.base = base
+
+    def _cell_origin(self, r, c):
+        return c * self.cell_size, r * self.cell_size + self.top_padding
+
+    def _draw_tile(self, key):
+        from PIL import Image, ImageDraw
+        size = self.cell_size
+        tile = Image.new("RGB", (size + 1, size + 1), color=ROAD_BG_COLOR)
+        draw = ImageDraw.Draw(tile)
+        draw.rectangle([(0, 0), (size, size)], outline="lightgray")
+        if key:
+            winner_char, is_correct, has_tie = key
+            color = "#3498db" if winner_char == "P" else "#e74c3c"
+            ellipse_coords = [(3, 3), (size - 3, size - 3)]
+            if is_correct:
+                draw.ellipse(ellipse_coords, fill=color, outline=color, width=2)
             else:
-                row += 1
-            if row >= rows:
-                col += 1
-                row = rows - 1
-            if col < full_grid_cols:
-                is_correct = "C" if pb_history_index in correct_indices else ""
-                full_grid[row][col] = winner + is_correct
-                last_positions[winner] = (row, col)
-            last_winner = winner
-
-    start_col = page * COLS_PER_PAGE
-    page_grid = [row[start_col : start_col + COLS_PER_PAGE] for row in full_grid]
-    
-    # [수정] 변수 선언을 여러 줄로 분리하여 UnboundLocalError 해결
-    top_padding = 30
-    width = COLS_PER_PAGE * cell_size
-    height = rows * cell_size + top_padding
-    
-    img = Image.new("RGB", (width, height), color="#f4f6f9")
-    draw = ImageDraw.Draw(img)
-    try:
-        font = ImageFont.truetype("arial.ttf", 16)
-    except IOError:
-        font = ImageFont.load_default()
-
-    _, total_pages = _get_page_info(history)
-    draw.text((10, 5), f"ZENTRA AI - Big Road (Page {page + 1} / {total_pages})", fill="black", font=font)
-
-    for r in range(rows):
-        for c in range(COLS_PER_PAGE):
-            x1, y1 = c * cell_size, r * cell_size + top_padding
-            x2, y2 = (c + 1) * cell_size, (r + 1) * cell_size + top_padding
-            draw.rectangle([(x1, y1), (x2, y2)], outline="lightgray")
-            cell_data = page_grid[r][c]
-            if cell_data:
-                winner_char, is_correct = cell_data[0], "C" in cell_data
-                color = "#3498db" if winner_char == "P" else "#e74c3c"
-                ellipse_coords = [(x1 + 3, y1 + 3), (x2 - 3, y2 - 3)]
-                if is_correct:
-                    draw.ellipse(ellipse_coords, fill=color, outline=color, width=2)
-                else:
-                    draw.ellipse(ellipse_coords, outline=color, width=2)
-                if "T" in cell_data:
-                    draw.line([(x1 + 5, y1 + 5), (x2 - 5, y2 - 5)], fill="#2ecc71", width=2)
-    
-    image_path = f"baccarat_road_{user_id}.png"
-    img.save(image_path)
-    return image_path
+                draw.ellipse(ellipse_coords, outline=color, width=2)
+            if has_tie:
+                draw.line([(5, 5), (size - 5, size - 5)], fill="#2ecc71", width=2)
+        return tile
+
+    def render(self, user_id, road, page):
+        """사용자의 현재 페이지 이미지를 PNG BytesIO로 반환"""
+        return self.render_page(user_id, page, road.total_pages, road.page_columns(page))
+
+    def render_page(self, user_id, page, total_pages, columns):
+        """페이지의 열 목록(BigRoad.page_columns)으로 이미지를 그린다
+        페이지의 모든 칸을 이전에 그린 상태와 비교하므로 기록이 초기화되어도 캔버스를 그대로 재사용한다."""
+        self.load_assets()
+        entry = self._canvases.pop(user_id, None)
+        if entry is None or entry[0] != page:
+            entry = [page, None, [None] * (COLS_PER_PAGE * self.rows), self.base.copy()]
+        self._canvases[user_id] = entry
+        while len(self._canvases) > self.max_canvases:
+            self._canvases.popitem(last=False)
+
+        with metrics.time("render"):
+            _, drawn_title, cells, img = entry
+            title = f"ZENTRA AI - Big Road (Page {page + 1} / {total_pages})"
+            if title != drawn_title:
+                from PIL import ImageDraw
+                draw = ImageDraw.Draw(img)
+                draw.rectangle([(0, 0), (self.width, self.top_padding - 1)], fill=ROAD_BG_COLOR)
+                draw.text((10, 5), title, fill="black", font=self.font)
+                entry[1] = title
+
+            for c, column in enumerate(columns):
+                for r, cell in enumerate(column):
+                    state = tuple(cell) if cell else None
+                    i = c * self.rows + r
+                    if state != cells[i]:
+                        key = (state[0], state[1], state[2] > 0) if state else None
+                        img.paste(self.sprites[key], self._cell_origin(r, c))
+                        cells[i] = state
+
+        buf = io.BytesIO()
+        with metrics.time("encode"):
+            img.save(buf, format="PNG", compress_level=1)
+        buf.seek(0)
+        buf.name = "big_road.png"
+        return buf
+
+road_renderer = RoadRenderer()
+
+def _render_page_png(user_id, page, total_pages, columns):
+    """렌더링 프로세스에서 실행되는 작업 (PNG 바이트 반환)"""
+    return road_renderer.render_page(user_id, page, total_pages, columns).getvalue()
+
+def _init_render_process():
+    """렌더링 프로세스 시작 시 종료 신호를 무시하고 렌더링 자원을 미리 준비"""
+    ignore_stop_signals()
+    road_renderer.load_assets()
+
+class RenderPool:
+    """빅로드 렌더링(PNG 인코딩 포함)을 별도 프로세스에서 실행해 이벤트 루프와 GIL 을 비워 둔다
+    같은 사용자는 항상 같은 프로세스로 보내 프로세스 안의 사용자별 캔버스 캐시가 유지된다.
+    processes 가 0이면 지금처럼 이벤트 루프에서 직접 그린다."""
+
+    def __init__(self, processes=RENDER_PROCESSES):
+        self.processes = processes
+        self._executors = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """렌더링 프로세스를 미리 띄워 둔다 (첫 렌더링이 프로세스 시작/모듈 import 를 기다리지 않도록)"""
+        if not self.processes:
+            return
+        futures = [executor.submit(int) for executor in self._pool()]
+        for future in futures:
+            future.result()
+
+    def _pool(self):
+        with self._lock:
+            if self._executors is None:
+                ctx = multiprocessing.get_context("spawn")
+                self._executors = [
+                    ProcessPoolExecutor(1, mp_context=ctx, initializer=_init_render_process)
+                    for _ in range(self.processes)
+                ]
+            return self._executors
+
+    def _executor(self, user_id):
+        return self._pool()[shard_for_user(user_id, self.processes)]
+
+    async def render(self, user_id, road, page):
+        """road 의 page 이미지를 PNG 바이트로 반환"""
+        if not self.processes:
+            return road_renderer.render(user_id, road, page).getvalue()
+        # page_columns 는 칸 상태의 사본(튜플)이라 다른 클릭이 road 를 바꿔도 영향이 없다
+        columns = road.page_columns(page)
+        loop = asyncio.get_running_loop()
+        with metrics.time("render_pool"):
+            return await loop.run_in_executor(
+                self._executor(user_id), _render_page_png, user_id, page, road.total_pages, columns
+            )
+
+    def close(self):
+        with self._lock:
+            executors, self._executors = self._executors, None
+        for executor in executors or ():
+            executor.shutdown(wait=True, cancel_futures=True)
+
+render_pool = RenderPool()
+
+class RenderCache:
+    """인코딩된 빅로드 PNG와 업로드 후 받은 텔레그램 file_id 를 보관하는 LRU 캐시
+    키는 (기록 해시, 페이지)이며 PNG 바이트 합계가 max_bytes 를 넘으면 오래된 것부터 버린다."""
+
+    def __init__(self, max_bytes=RENDER_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> [png bytes, file_id]
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, png):
+        old = self._entries.pop(key, None)
+        if old:
+            self.size -= len(old[0])
+        entry = [png, None]
+        self._entries[key] = entry
+        self.size += len(png)
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+        return entry
+
+    def set_file_id(self, key, file_id):
+        entry = self._entries.get(key)
+        if entry:
+            entry[1] = file_id
+
+    def drop_file_id(self, key):
+        self.set_file_id(key, None)
+
+render_cache = RenderCache()
+
+def create_big_road_image(user_id):
+    """사용자의 빅로드 이미지를 BytesIO(PNG)로 생성"""
+    session = session_store.get(user_id)
+    return road_renderer.render(user_id, session.road, session.page)
+
+def road_image_key(session):
+    return session.road.digest, session.page
+
+async def get_road_media(user_id):
+    """이미지 캐시 키와 함께 전송할 사진(file_id 또는 PNG BytesIO)을 반환"""
+    session = session_store.get(user_id)
+    key = road_image_key(session)
+    entry = render_cache.get(key)
+    if entry is None:
+        png = await render_pool.render(user_id, session.road, session.page)
+        entry = render_cache.put(key, png)
+    if entry[1]:
+        return key, entry[1]
+    buf = io.BytesIO(entry[0])
+    buf.name = "big_road.png"
+    return key, buf
+
+def remember_file_id(key, message):
+    """업로드된 사진의 file_id 를 저장해 다음부터 바이트 대신 재사용"""
+    photo = getattr(message, "photo", None)
+    if photo:
+        render_cache.set_file_id(key, photo[-1].file_id)
 
 
 # --- AI 및 UI 관련 함수 ---
-def get_gpt4_recommendation(user_id, game_history):
-    with get_db_conn() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT recommendation, outcome FROM results_log WHERE user_id=?", (user_id,))
-        ai_performance_history = [{"recommendation": r[0], "outcome": r[1]} for r in cursor.fetchall()]
-
-    performance_text = "기록된 추천 실적이 없습니다."
-    if ai_performance_history:
-        performance_text = "아래는 당신(AI)의 과거 추천 기록과 그 실제 결과입니다:\n"
-        for i, record in enumerate(ai_performance_history[-10:]):
-            outcome_text = "승리" if record.get("outcome") == "win" else "패배"
-            performance_text += f"{i+1}. 추천: {record.get('recommendation', 'N/A')}, 실제 결과: {outcome_text}\n"
-    
-    # [수정] 사용자님의 경험을 AI에게 지시하는 프롬프트 항목 추가
-    prompt = f"""
-    당신은 세계 최고의 50년 경력의 바카라 데이터 분석가입니다. 당신의 임무는 주어진 데이터를 분석하여 가장 확률 높은 다음 베팅을 추천하는 것입니다.
+def get_openai_client():
+    """OpenAI 클라이언트 (처음 쓸 때 openai 패키지를 import 하고 한 번만 생성)"""
+    global client
+    if client is None:
+        with _client_lock:
+            if client is None:
+                from openai import AsyncOpenAI
+                client = AsyncOpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT, max_retries=1)
+    return client
 
-    [데이터 1: 현재 게임의 흐름]
-    {game_history}
+def fetch_performance_history(user_id):
+    """최근 AI 추천 실적 (오래된 것부터, 최대 PERFORMANCE_HISTORY_SIZE 건)"""
+    return [{"recommendation": r, "outcome": o} for r, o in recent_results.get(user_id)]
 
-    [데이터 2: 당신의 과거 추천 실적]
-    {performance_text}
+# 고정 지침은 모두 system 메시지에 두고, 사용자마다 달라지는 데이터만 user 메시지에 넣는다
+# (약 550토큰이라 provider 프롬프트 캐시 최소 길이(1024토큰)에 못 미치므로 그 캐시는 기대하지 않는다)
+SYSTEM_PROMPT = """You are a world-class Baccarat analyst with 50 years of experience who provides deep strategic reasoning.
+당신은 세계 최고의 50년 경력의 바카라 데이터 분석가입니다. 당신의 임무는 주어진 데이터를 분석하여 가장 확률 높은 다음 베팅을 추천하는 것입니다.
 
-    [데이터 3: 베팅 전략 추가 지침 (사용자 경험)]
-    1. 단순히 마지막 결과를 따라가는 추천은 절대 지양한다.
-    2. 플레이어든 뱅커든, 한쪽의 결과가 5번 이상 연속되면(장줄), 반대 결과가 나올 확률을 더 높게 고려한다.
-    3. 플레이어와 뱅커가 번갈아 나오는 전환(일명 '퐁당' 또는 'chop') 패턴이 나타나는지 주의 깊게 살핀다.
-    4. 전체적인 흐름을 보고, 연속(streak) 패턴과 전환(chop) 패턴 중 현재 어떤 패턴이 더 우세한지 판단하여 추천한다.
+[데이터 형식]
+- 현재 게임의 흐름: 오래된 것부터 결과와 연속 횟수를 적은 표기입니다 (예: B3 P1 T1 = Banker 3연속, Player 1번, Tie 1번).
+  기록이 길면 앞부분은 P/B/T 횟수로만 요약되어 있습니다.
+- 과거 추천 실적: 오래된 것부터 추천과 실제 결과입니다 (예: P승 = Player 추천 적중, B패 = Banker 추천 실패).
 
-    [분석 및 추천]
-    위 3가지 데이터와 지침을 종합적으로 분석하여, 최종 추천을 "추천:" 이라는 단어 뒤에 Player 또는 Banker 로만 결론내려주십시오.
-    """
-    try:
-        completion = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "You are a world-class Baccarat analyst with 50 years of experience who provides deep strategic reasoning."},
-                {"role": "user", "content": prompt},
-            ],
+[베팅 전략 추가 지침 (사용자 경험)]
+1. 단순히 마지막 결과를 따라가는 추천은 절대 지양한다.
+2. 플레이어든 뱅커든, 한쪽의 결과가 5번 이상 연속되면(장줄), 반대 결과가 나올 확률을 더 높게 고려한다.
+3. 플레이어와 뱅커가 번갈아 나오는 전환(일명 '퐁당' 또는 'chop') 패턴이 나타나는지 주의 깊게 살핀다.
+4. 전체적인 흐름을 보고, 연속(streak) 패턴과 전환(chop) 패턴 중 현재 어떤 패턴이 더 우세한지 판단하여 추천한다.
+
+[분석 및 추천]
+주어진 데이터와 지침을 종합적으로 분석하여, 최종 추천을 "추천:" 이라는 단어 뒤에 Player 또는 Banker 로만 결론내려주십시오."""
+
+def estimate_tokens(text):
+    """토크나이저 없이 대략적인 토큰 수 (영문/숫자 2자당 1토큰, 한글 등은 1자당 1토큰)"""
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return ascii_chars // 2 + len(text) - ascii_chars
+
+def compress_history(history, budget=PROMPT_HISTORY_TOKENS):
+    """게임 기록("PBT" 문자열)을 런렝스 표기로 압축
+    budget 토큰을 넘으면 최근 구간만 남기고 앞부분은 P/B/T 횟수 요약으로 바꾼다."""
+    if not history:
+        return "기록 없음"
+    runs = [(winner, sum(1 for _ in group)) for winner, group in itertools.groupby(history)]
+    kept, chars, skipped = [], 0, len(history)
+    for winner, count in reversed(runs):
+        token = f"{winner}{count}"
+        chars += len(token) + 1
+        if kept and chars // 2 > budget:  # 런렝스 표기는 영문/숫자뿐이므로 estimate_tokens 와 같은 2자당 1토큰
+            break
+        kept.append(token)
+        skipped -= count
+    text = " ".join(reversed(kept))
+    if skipped:
+        head = history[:skipped]
+        text = f"(앞선 {skipped}핸드: P {head.count('P')}, B {head.count('B')}, T {head.count('T')}) {text}"
+    return text
+
+def summarize_performance(ai_performance_history):
+    """최근 추천 실적을 한 줄로 요약 (예: 최근 3건 2승 1패: P승 B패 B승)"""
+    if not ai_performance_history:
+        return "기록된 추천 실적이 없습니다."
+    marks = [
+        f"{(record.get('recommendation') or 'N')[0]}{'승' if record.get('outcome') == 'win' else '패'}"
+        for record in ai_performance_history
+    ]
+    wins = sum(mark.endswith("승") for mark in marks)
+    return f"최근 {len(marks)}건 {wins}승 {len(marks) - wins}패: {' '.join(marks)}"
+
+def build_recommendation_messages(history, ai_performance_history, pattern_summary=None, budget=PROMPT_HISTORY_TOKENS):
+    """GPT 추천 요청 메시지 목록 (실서비스와 백테스트가 같은 프롬프트를 쓰도록 분리)
+    사용자마다 달라지는 데이터만 user 메시지에 넣는다."""
+    return recommendation_messages(
+        compress_history(history, budget), summarize_performance(ai_performance_history), pattern_summary
+    )
+
+def recommendation_messages(history_text, performance_text, pattern_summary=None):
+    """이미 압축/요약한 기록과 실적으로 메시지 목록을 만든다"""
+    prompt = f"""[데이터 1: 현재 게임의 흐름]
+{history_text}
+
+[데이터 2: 당신의 과거 추천 실적]
+{performance_text}
+
+[데이터 3: 로컬 패턴 분석 결과]
+{pattern_summary or "없음"}"""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+
+def prompt_key(model, messages):
+    """모델과 메시지 내용으로 만든 캐시 키"""
+    digest = hashlib.sha256(model.encode())
+    for message in messages:
+        digest.update(b"\0" + message["role"].encode() + b"\0" + message["content"].encode())
+    return digest.hexdigest()
+
+def recommendation_key(model, history_text, performance_text):
+    """추천 캐시 키: 모델, 고정 지침, 압축된 기록, 실적 요약만으로 만든다
+    로컬 패턴 요약은 전체 기록(최장 연속, 전체 전환 비율 등)에서 계산되어 압축으로 정규화되지 않으므로 키에서 뺀다.
+    기록이 압축 예산 안이면 패턴 요약도 압축된 기록으로 정해지므로 키가 같으면 프롬프트도 같다."""
+    return prompt_key(model, [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"{history_text}\n{performance_text}"},
+    ])
+
+class PromptCache:
+    """recommendation_key -> GPT 추천 결과 LRU+TTL 캐시
+    압축된 기록과 실적 요약이 같으면 사용자가 달라도 같은 키가 된다.
+    메모리에 없으면 prompt_cache 테이블에서 찾고, 새 결과는 write-behind 로 저장한다."""
+
+    def __init__(self, max_entries=PROMPT_CACHE_SIZE, ttl=PROMPT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (recommendation, 저장 시각)
+
+    def get(self, key):
+        if self.ttl <= 0:
+            return None
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._load(key)
+            if entry:
+                self._remember(key, entry)
+        else:
+            self._entries.move_to_end(key)
+        if entry is None or time.time() - entry[1] > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, recommendation):
+        if self.ttl <= 0:
+            return
+        created = time.time()
+        self._remember(key, (recommendation, created))
+        db_writer.submit(
+            "INSERT OR REPLACE INTO prompt_cache (key, recommendation, created) VALUES (?, ?, ?)",
+            (key, recommendation, created),
         )
-        response = completion.choices[0].message.content
-        part = response.split("추천:")[-1] if "추천:" in response else response
-        
-        if "Player" in part or "플레이어" in part: return "Player"
-        if "Banker" in part or "뱅커" in part: return "Banker"
-        return "Banker" # 명확한 단어가 없으면 기본값으로 Banker 반환
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _load(self, key):
+        with get_db_conn() as conn:
+            return conn.execute("SELECT recommendation, created FROM prompt_cache WHERE key=?", (key,)).fetchone()
+
+prompt_cache = PromptCache()
+
+def parse_recommendation(response):
+    """GPT 응답에서 'Player' / 'Banker' 추천을 뽑아냄"""
+    part = response.split("추천:")[-1] if "추천:" in response else response
+    if "Player" in part or "플레이어" in part: return "Player"
+    if "Banker" in part or "뱅커" in part: return "Banker"
+    return "Banker" # 명확한 단어가 없으면 기본값으로 Banker 반환
+
+async def get_gpt4_recommendation(user_id, history, pattern_summary=None):
+    """이벤트 루프를 막지 않고 GPT-4o 추천을 받아오는 함수 (타임아웃/동시 호출 수 제한)
+    압축된 기록과 실적 요약이 같은 추천이 캐시에 있으면 API 를 호출하지 않고,
+    같은 키의 호출이 이미 진행 중이면 (예: 여러 사용자의 슈 첫 핸드) 그 결과를 함께 기다린다."""
+    history_text = compress_history(history)
+    performance_text = summarize_performance(fetch_performance_history(user_id))
+    key = recommendation_key(OPENAI_MODEL, history_text, performance_text)
+    cached = prompt_cache.get(key)
+    if cached:
+        metrics.inc("llm_requests_total", result="cached")
+        return cached
+    entry = llm_inflight.get(key)
+    if entry is None:
+        messages = recommendation_messages(history_text, performance_text, pattern_summary)
+        entry = llm_inflight[key] = [spawn(_request_recommendation(key, messages)), 0]
+        entry[0].add_done_callback(lambda _: llm_inflight.get(key) is entry and llm_inflight.pop(key))
+    else:
+        metrics.inc("llm_requests_total", result="coalesced")
+    entry[1] += 1
+    try:
+        # 한 요청의 분석이 취소되어도 같은 키를 기다리는 다른 요청을 위해 호출은 계속한다
+        return await asyncio.shield(entry[0])
+    finally:
+        entry[1] -= 1
+        if not entry[1] and not entry[0].done():  # 아무도 기다리지 않으면 호출도 취소
+            if llm_inflight.get(key) is entry:
+                del llm_inflight[key]
+            entry[0].cancel()
+
+async def _request_recommendation(key, messages):
+    try:
+        async with openai_semaphore:
+            with metrics.time("openai"):
+                completion = await asyncio.wait_for(
+                    get_openai_client().chat.completions.create(
+                        model=OPENAI_MODEL,
+                        messages=messages,
+                        timeout=OPENAI_TIMEOUT,
+                    ),
+                    OPENAI_TIMEOUT,
+                )
+        usage = getattr(completion, "usage", None)
+        if usage:
+            metrics.inc("llm_tokens_total", usage.prompt_tokens or 0, kind="prompt")
+            metrics.inc("llm_tokens_total", usage.completion_tokens or 0, kind="completion")
+        metrics.inc("llm_requests_total", result="ok")
+        recommendation = parse_recommendation(completion.choices[0].message.content)
+        prompt_cache.put(key, recommendation)
+        return recommendation
+    except asyncio.TimeoutError:
+        metrics.inc("llm_requests_total", result="timeout")
+        print(f"GPT-4 API Timeout: {OPENAI_TIMEOUT}초 초과")
+        return None
     except Exception as e:
+        metrics.inc("llm_requests_total", result="error")
         print(f"GPT-4 API Error: {e}")
         return None
 
 def build_caption_text(user_id, is_analyzing=False):
-    data = user_data.get(user_id, {})
-    player_wins, banker_wins = data.get("player_wins", 0), data.get("banker_wins", 0)
-    recommendation = data.get("recommendation", None)
+    session = session_store.get(user_id)
+    player_wins, banker_wins = session.player_wins, session.banker_wins
+    recommendation = session.recommendation
     feedback_stats = get_feedback_stats(user_id)
     guide_text = "...\n(처음 시작 시 P나 B를 선택 후 '자동분석시작'을 클릭하세요.)\n..."
     
     rec_text = ""
-    if is_analyzing:
+    if is_analyzing and session.recommender_mode == "local_then_llm" and recommendation:
+        rec_text = (
+            f"\n\n👇 *AI 추천* 👇\n{'🔴' if recommendation == 'Banker' else '🔵'} *{escape_markdown(recommendation + '에 베팅참조하세요.')}*"
+            f"\n_{escape_markdown('(로컬 분석 결과, GPT가 추가 분석 중입니다...)')}_"
+        )
+    elif is_analyzing:
         rec_text = f"\n\n👇 *AI 추천* 👇\n_{escape_markdown('AI가 분석 중입니다...')}_"
     elif recommendation:
         rec_text = f"\n\n👇 *AI 추천* 👇\n{'🔴' if recommendation == 'Banker' else '🔵'} *{escape_markdown(recommendation + '에 베팅참조하세요.')}*"
@@ -310,10 +1887,9 @@ def build_caption_text(user_id, is_analyzing=False):
     )
 
 def build_keyboard(user_id):
-    data = user_data.get(user_id, {})
-    page, history = data.get("page", 0), data.get("history", [])
-    _, total_pages = _get_page_info(history)
-    auto_analysis = data.get("auto_analysis_enabled", True)
+    session = session_store.get(user_id)
+    page, total_pages = session.page, session.road.total_pages
+    auto_analysis = session.auto_analysis_enabled
     
     page_buttons = []
     if total_pages > 1:
@@ -330,8 +1906,11 @@ def build_keyboard(user_id):
         InlineKeyboardButton("🔍자동 분석 시작", callback_data="analyze"),
         InlineKeyboardButton("🔄기록 초기화", callback_data="reset"),
     ])
+    keyboard.append([
+        InlineKeyboardButton(f"🧠 분석 모드: {RECOMMENDER_MODES.get(session.recommender_mode, 'GPT')}", callback_data="cycle_mode"),
+    ])
 
-    if data.get("recommendation"):
+    if session.recommendation:
         stats = get_feedback_stats(user_id)
         keyboard.append([
             InlineKeyboardButton(f'✅AI 분석 승({stats["win"]})', callback_data="feedback_win"),
@@ -340,91 +1919,410 @@ def build_keyboard(user_id):
     return InlineKeyboardMarkup(keyboard)
 
 
+# --- 텔레그램 API 발신 스케줄러 ---
+class TokenBucket:
+    """초당 rate 개씩 채워지고 최대 capacity 개까지 모이는 토큰 버킷"""
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now):
+        """토큰 하나를 쓸 수 있을 때까지 남은 시간(초)"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, until):
+        self.blocked_until = max(self.blocked_until, until)
+
+class OutboundJob:
+    __slots__ = ("key", "chat_id", "factory", "future", "attempts", "ready_at")
+
+    def __init__(self, key, chat_id, factory, future):
+        self.key = key
+        self.chat_id = chat_id
+        self.factory = factory
+        self.future = future
+        self.attempts = 0
+        self.ready_at = 0.0
+
+SUPERSEDED = object()  # 같은 메시지에 대한 더 새로운 요청으로 대체되어 보내지 않은 요청의 결과
+
+class OutboundScheduler:
+    """텔레그램 API 호출을 전체/채팅별 토큰 버킷에 맞춰 내보내는 스케줄러
+    - 같은 key(같은 메시지 수정)로 아직 보내지 않은 요청이 있으면 최신 요청만 보낸다 (이전 요청은 SUPERSEDED)
+    - RetryAfter 를 받으면 해당 채팅(또는 전체)을 지정 시간만큼 멈추고 다시 보내며, 네트워크 오류는 지수 백오프로 재시도
+    - 같은 key 의 요청은 동시에 보내지 않아 순서가 뒤바뀌지 않는다
+    - 콜백 응답(post_immediate)은 버킷을 거치지 않고 바로 보낸다 (메시지 전송/수정만 속도 제한 대상)"""
+
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE, chat_burst=TELEGRAM_CHAT_BURST):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.pending = OrderedDict()  # key -> OutboundJob
+        self.in_flight = set()  # 전송 중인 key
+        self.immediate = set()  # 버킷을 거치지 않고 전송 중인 작업
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.failed = 0
+        self._wakeup = None
+        self._task = None
+
+    @property
+    def depth(self):
+        return len(self.pending)
+
+    def stats(self):
+        return {
+            "queue_depth": self.depth, "in_flight": len(self.in_flight) + len(self.immediate), "sent": self.sent,
+            "coalesced": self.coalesced, "retried": self.retried, "failed": self.failed,
+        }
+
+    def submit(self, chat_id, factory, key=None):
+        """factory() 코루틴 호출을 예약하고 결과 Future 를 반환"""
+        if key is None:
+            key = object()
+        job = OutboundJob(key, chat_id, factory, asyncio.get_running_loop().create_future())
+        old = self.pending.get(key)
+        self.pending[key] = job
+        if old is not None:
+            self.coalesced += 1
+            if not old.future.done():
+                old.future.set_result(SUPERSEDED)
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+        return job.future
+
+    async def call(self, chat_id, factory, key=None):
+        return await self.submit(chat_id, factory, key)
+
+    def post(self, chat_id, factory):
+        """결과를 기다리지 않는 호출 (오류는 로그만 남김)"""
+        self.submit(chat_id, factory).add_done_callback(_log_outbound_error)
+
+    def post_immediate(self, factory):
+        """토큰 버킷을 거치지 않고 바로 보내는 호출 (결과를 기다리지 않음, 오류는 로그만 남김)
+        answerCallbackQuery 는 메시지 전송 한도와 상관이 없고, 늦으면 쿼리가 만료되어 버튼 로딩 표시가 멈추지 않는다."""
+        task = asyncio.create_task(self._send_immediate(factory))
+        self.immediate.add(task)
+        task.add_done_callback(self.immediate.discard)
+
+    async def _send_immediate(self, factory):
+        try:
+            with metrics.time("telegram_api"):
+                await factory()
+        except Exception as e:
+            self.failed += 1
+            print(f"텔레그램 API 호출 오류: {e}")
+        else:
+            self.sent += 1
+
+    async def join(self):
+        """대기/전송 중인 요청이 모두 끝날 때까지 대기"""
+        while self.pending or self.in_flight or self.immediate:
+            await asyncio.sleep(0.05)
+
+    def _chat_bucket(self, chat_id):
+        if chat_id is None:
+            return None
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:  # 꽉 찬(쉬고 있는) 버킷 정리
+                now = time.monotonic()
+                for cid in [c for c, b in self.chat_buckets.items() if b.delay(now) == 0 and b.tokens >= b.capacity]:
+                    del self.chat_buckets[cid]
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            wait = None
+            for key, job in list(self.pending.items()):
+                if key in self.in_flight:
+                    continue
+                chat_bucket = self._chat_bucket(job.chat_id)
+                delay = max(job.ready_at - now, chat_bucket.delay(now) if chat_bucket else 0.0)
+                global_delay = self.global_bucket.delay(now)
+                if delay > 0 or global_delay > 0:
+                    wait = min(wait if wait is not None else math.inf, max(delay, global_delay))
+                    if global_delay > 0:
+                        break
+                    continue
+                self.global_bucket.take()
+                if chat_bucket:
+                    chat_bucket.take()
+                del self.pending[key]
+                self.in_flight.add(key)
+                asyncio.create_task(self._send(job))
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send(self, job):
+        retry_delay = None
+        try:
+            with metrics.time("telegram_api"):
+                result = await job.factory()
+        except RetryAfter as e:
+            retry_after = getattr(e.retry_after, "total_seconds", lambda: e.retry_after)()
+            bucket = self._chat_bucket(job.chat_id) or self.global_bucket
+            bucket.block(time.monotonic() + retry_after)
+            retry_delay = retry_after
+        except BadRequest as e:
+            self._finish(job, exception=e)
+        except NetworkError as e:
+            if job.attempts < TELEGRAM_MAX_RETRIES:
+                retry_delay = 0.5 * 2 ** job.attempts
+            else:
+                self._finish(job, exception=e)
+        except Exception as e:
+            self._finish(job, exception=e)
+        else:
+            self.sent += 1
+            self._finish(job, result=result)
+        finally:
+            self.in_flight.discard(job.key)
+            if retry_delay is not None:
+                self._retry(job, retry_delay)
+            self._wakeup.set()
+
+    def _retry(self, job, delay):
+        if job.key in self.pending or job.future.done():  # 그 사이 더 새로운 요청이 들어옴
+            self._finish(job, result=SUPERSEDED)
+            return
+        self.retried += 1
+        job.attempts += 1
+        job.ready_at = time.monotonic() + delay
+        self.pending[job.key] = job
+
+    def _finish(self, job, result=None, exception=None):
+        if exception is not None:
+            self.failed += 1
+        if job.future.done():
+            return
+        if exception is not None:
+            job.future.set_exception(exception)
+        else:
+            job.future.set_result(result)
+
+def _log_outbound_error(future):
+    if not future.cancelled() and future.exception():
+        print(f"텔레그램 API 호출 오류: {future.exception()}")
+
+outbound = OutboundScheduler()
+
 # --- 텔레그램 핸들러 ---
+async def send_edit(chat_id, factory, key):
+    """메시지 수정 요청을 발신 스케줄러로 보내고 대기 시간을 포함한 소요 시간을 기록"""
+    with metrics.time("telegram_edit"):
+        return await outbound.call(chat_id, factory, key=key)
+
 async def update_message(context, query, user_id, is_analyzing=False):
-    """메시지(사진, 캡션, 키보드)를 업데이트하는 헬퍼 함수"""
+    """메시지(사진, 캡션, 키보드)를 업데이트하는 헬퍼 함수
+    이미지가 그대로면 캡션/키보드만 수정하고, 이미 올린 이미지는 file_id 로 재사용"""
+    session = session_store.get(user_id)
+    caption = build_caption_text(user_id, is_analyzing=is_analyzing)
+    keyboard = build_keyboard(user_id)
+    message_id = query.message.message_id if query.message else None
+    chat_id = query.message.chat_id if query.message else None
+    edit_key = ("edit", chat_id, message_id) if message_id else None
+    key = road_image_key(session)
+    shown = (message_id, key, hash(caption), hash(keyboard))
     try:
-        image_path = create_big_road_image(user_id)
-        media = InputMediaPhoto(
-            media=open(image_path, "rb"),
-            caption=build_caption_text(user_id, is_analyzing=is_analyzing),
-            parse_mode=ParseMode.MARKDOWN_V2,
-        )
-        await query.edit_message_media(media=media, reply_markup=build_keyboard(user_id))
+        if session.shown and session.shown[:2] == shown[:2]:
+            if session.shown[2] != shown[2]:
+                sent = await send_edit(chat_id, lambda: query.edit_message_caption(
+                    caption=caption, parse_mode=ParseMode.MARKDOWN_V2, reply_markup=keyboard
+                ), edit_key)
+            elif session.shown[3] != shown[3]:
+                sent = await send_edit(chat_id, lambda: query.edit_message_reply_markup(reply_markup=keyboard), edit_key)
+            else:
+                sent = None
+        else:
+            key, photo = await get_road_media(user_id)
+            media = InputMediaPhoto(media=photo, caption=caption, parse_mode=ParseMode.MARKDOWN_V2)
+            try:
+                sent = await send_edit(chat_id, lambda: query.edit_message_media(media=media, reply_markup=keyboard), edit_key)
+            except BadRequest as e:
+                if not isinstance(photo, str) or "Message is not modified" in str(e):
+                    raise
+                # file_id 가 더 이상 유효하지 않으면 바이트로 다시 업로드
+                render_cache.drop_file_id(key)
+                key, photo = await get_road_media(user_id)
+                media = InputMediaPhoto(media=photo, caption=caption, parse_mode=ParseMode.MARKDOWN_V2)
+                sent = await send_edit(chat_id, lambda: query.edit_message_media(media=media, reply_markup=keyboard), edit_key)
+            if sent is not SUPERSEDED:
+                remember_file_id(key, sent)
+        if sent is SUPERSEDED:
+            return
     except Exception as e:
         if "Message is not modified" not in str(e):
             print(f"메시지 업데이트 오류: {e}")
+            return
+    session.shown = shown
+
+def cancel_analysis(user_id):
+    """진행 중인 AI 분석 요청이 있으면 취소하는 함수"""
+    task = analysis_tasks.pop(user_id, None)
+    if task and not task.done():
+        task.cancel()
+        metrics.inc("analysis_superseded_total")
+
+def apply_recommendation(session, recommendation):
+    """추천 결과를 세션에 반영"""
+    session.recommendation = recommendation
+    session.recommendation_info = {
+        "bet_on": recommendation,
+        "at_round": session.road.pb_count,
+    }
 
 async def run_analysis(user_id):
-    """AI 분석을 실행하고 user_data를 업데이트하는 함수"""
-    data = user_data.get(user_id)
-    if not data: return
-    
-    history_str = ", ".join(data.get("history", []))
-    new_recommendation = get_gpt4_recommendation(user_id, history_str)
-    
-    if new_recommendation:
-        data["recommendation"] = new_recommendation
-        data["recommendation_info"] = {
-            "bet_on": new_recommendation,
-            "at_round": len([h for h in data.get("history", []) if h != "T"]),
-        }
+    """AI 분석을 실행하고 세션의 추천을 갱신하는 함수
+    결과가 최신 기록에 대한 것이 아니면 False를 반환
+    GPT 호출이 실패하거나 시간 초과되면 로컬 패턴 엔진의 추천을 사용"""
+    await preload_user(user_id)
+    session = session_store.get(user_id)
+    history = bytes(session.history)
+    if session.recommender_mode == "local":
+        apply_recommendation(session, session.patterns.recommend())
+        session_store.save(session)
+        return True
+
+    new_recommendation = await get_gpt4_recommendation(
+        user_id, session.history_text, session.patterns.describe()
+    )
+    if session_store.peek(user_id) is not session or session.history != history:
+        return False
+
+    apply_recommendation(session, new_recommendation or session.patterns.recommend())
+    session_store.save(session)
+    return True
+
+def spawn(coroutine):
+    """백그라운드 작업 생성 (종료 시 drain_background_tasks 로 완료를 기다림)"""
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(_background_task_done)
+    return task
+
+def _background_task_done(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        print(f"백그라운드 작업 오류: {task.exception()}")
+
+async def drain_background_tasks():
+    """진행 중인 분석/화면 갱신 작업이 모두 끝날 때까지 대기"""
+    while background_tasks:
+        await asyncio.gather(*background_tasks, return_exceptions=True)
 
+def request_analysis(context, query, user_id):
+    """AI 분석 요청 (이전 요청은 취소하고, 입력이 UI_DEBOUNCE_SECONDS 동안 멈추면 최신 기록으로 한 번만 실행)"""
+    cancel_analysis(user_id)
+    analysis_tasks[user_id] = spawn(_analysis_worker(context, query, user_id))
+
+async def _analysis_worker(context, query, user_id):
+    this = asyncio.current_task()
+    try:
+        await asyncio.sleep(UI_DEBOUNCE_SECONDS)
+        applied = await run_analysis(user_id)
+    finally:
+        if analysis_tasks.get(user_id) is this:
+            del analysis_tasks[user_id]
+    if applied:
+        schedule_refresh(context, query, user_id)
+
+def schedule_refresh(context, query, user_id):
+    """화면 갱신 요청: 첫 요청은 바로 반영하고, 이후 UI_DEBOUNCE_SECONDS 안에 들어온 요청은 한 번으로 합친다"""
+    entry = ui_refreshes.get(user_id)
+    if entry is not None:
+        entry[:] = [context, query, True]
+        metrics.inc("ui_refresh_coalesced_total")
+        return
+    ui_refreshes[user_id] = [context, query, True]
+    spawn(_refresh_worker(user_id))
+
+async def _refresh_worker(user_id):
+    entry = ui_refreshes[user_id]
+    try:
+        while entry[2]:
+            entry[2] = False
+            await update_message(entry[0], entry[1], user_id, is_analyzing=user_id in analysis_tasks)
+            await asyncio.sleep(UI_DEBOUNCE_SECONDS)
+    finally:
+        ui_refreshes.pop(user_id, None)
+
+@timed("start")
 async def start(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
-    log_activity(user.id, "start")
+    log_activity(user.id, "start", username=user.username)
     # [수정] auto_analysis_enabled의 기본값을 False로 변경
-    user_data[user.id] = {
-        "player_wins": 0, "banker_wins": 0, "history": [], "recommendation": None,
-        "page": 0, "correct_indices": [], "auto_analysis_enabled": False,
-    }
-    image_path = create_big_road_image(user.id)
-    await update.message.reply_photo(
-        photo=open(image_path, "rb"),
-        caption=build_caption_text(user.id),
-        reply_markup=build_keyboard(user.id),
-        parse_mode=ParseMode.MARKDOWN_V2,
-    )
+    cancel_analysis(user.id)
+    await preload_user(user.id)
+    session = session_store.reset(user.id)
+    key, photo = await get_road_media(user.id)
+    caption, keyboard = build_caption_text(user.id), build_keyboard(user.id)
+    with metrics.time("telegram_send"):
+        sent = await outbound.call(update.message.chat_id, lambda: update.message.reply_photo(
+            photo=photo,
+            caption=caption,
+            reply_markup=keyboard,
+            parse_mode=ParseMode.MARKDOWN_V2,
+        ))
+    remember_file_id(key, sent)
+    session.shown = (sent.message_id, key, hash(caption), hash(keyboard))
 
 # --- 버튼 콜백 ---
+@timed("callback")
 async def button_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     user_id = query.from_user.id
-    await query.answer()
+    outbound.post_immediate(query.answer)
 
-    lock = user_locks[user_id]
-    if lock.locked():
-        return
-
-    async with lock:
-        if user_id not in user_data:
-            user_data[user_id] = {
-                "player_wins": 0, "banker_wins": 0, "history": [], "recommendation": None,
-                "page": 0, "correct_indices": [], "auto_analysis_enabled": False,
-            }
-
-        data = user_data[user_id]
+    # 빠른 연속 클릭도 버리지 않고 도착 순서대로 세션에 바로 반영 (화면 갱신/분석은 디바운스)
+    waited = time.perf_counter()
+    async with session_store.lock(user_id):
+        metrics.observe("stage_seconds", time.perf_counter() - waited, stage="lock_wait")
+        await preload_user(user_id)
+        session = session_store.get(user_id)
         action = query.data
-        log_activity(user_id, "button_click", action)
+        metrics.inc("clicks_total", action=action_label(action))
+        log_activity(user_id, "button_click", action, query.from_user.username)
 
         should_analyze = False
         update_ui_only = False
 
         if action in ["P", "B", "T"]:
-            data["history"].append(action)
-            if action == "P": data["player_wins"] += 1
-            elif action == "B": data["banker_wins"] += 1
-            data["recommendation"] = None
+            session.record_result(action)
+            session.recommendation = None
             
             # [수정] 'T'를 눌렀을 때도 자동 분석이 실행되도록 조건 변경
-            if data.get("auto_analysis_enabled", False):
+            if session.auto_analysis_enabled:
                 should_analyze = True
             else:
                 update_ui_only = True
         
         elif action in ["feedback_win", "feedback_loss"]:
-            rec_info = data.get("recommendation_info")
-            if not rec_info: return
+            rec_info = session.recommendation_info
+            if not rec_info:
+                metrics.inc("clicks_dropped_total", reason="no_recommendation")
+                return
             
             recommendation = rec_info["bet_on"]
             outcome = "win" if action == "feedback_win" else "loss"
@@ -432,64 +2330,669 @@ async def button_callback(update: Update, context: CallbackContext) -> None:
 
             if outcome == "win":
                 result_to_add = "P" if recommendation == "Player" else "B"
-                pb_history = [h for h in data["history"] if h != "T"]
-                data.setdefault("correct_indices", []).append(len(pb_history))
             else:
                 result_to_add = "P" if recommendation == "Banker" else "B"
-            
-            data["history"].append(result_to_add)
-            if result_to_add == "P": data["player_wins"] += 1
-            else: data["banker_wins"] += 1
+            session.record_result(result_to_add, correct=outcome == "win")
             should_analyze = True
 
         elif action == "reset":
+            cancel_analysis(user_id)
             log_reset(user_id)
-            user_data[user_id].update({
-                "player_wins": 0, "banker_wins": 0, "history": [], "recommendation": None,
-                "page": 0, "correct_indices": [], "auto_analysis_enabled": False,
-            })
+            session.reset()
             update_ui_only = True
             
         elif action == "toggle_auto_analysis":
-            data["auto_analysis_enabled"] = not data.get("auto_analysis_enabled", False)
-            if not data["auto_analysis_enabled"]:
-                 data["recommendation"] = None
-                 data["recommendation_info"] = None
+            session.auto_analysis_enabled = not session.auto_analysis_enabled
+            if not session.auto_analysis_enabled:
+                 cancel_analysis(user_id)
+                 session.recommendation = None
+                 session.recommendation_info = None
+            update_ui_only = True
+
+        elif action == "cycle_mode":
+            modes = list(RECOMMENDER_MODES)
+            current = modes.index(session.recommender_mode) if session.recommender_mode in modes else 0
+            session.recommender_mode = modes[(current + 1) % len(modes)]
             update_ui_only = True
 
         elif action in ["page_next", "page_prev"]:
-            if action == "page_next": data["page"] += 1
-            else: data["page"] = max(0, data["page"] - 1)
+            if action == "page_next": session.page += 1
+            else: session.page = max(0, session.page - 1)
             update_ui_only = True
 
         elif action == "analyze":
-            if not data["history"]: return
-            data["auto_analysis_enabled"] = True
+            if not session.history:
+                metrics.inc("clicks_dropped_total", reason="empty_history")
+                return
+            session.auto_analysis_enabled = True
             should_analyze = True
         
         if action in ["P", "B", "T", "feedback_win", "feedback_loss"]:
-             _, total_pages = _get_page_info(data["history"])
-             data["page"] = max(0, total_pages - 1)
+             session.page = session.road.total_pages - 1
+
+        # 로컬 엔진 결과는 즉시 반영 (로컬 모드는 GPT 호출 없이 바로 완료)
+        if should_analyze and session.recommender_mode == "local":
+            cancel_analysis(user_id)
+            apply_recommendation(session, session.patterns.recommend())
+            should_analyze, update_ui_only = False, True
+        elif should_analyze and session.recommender_mode == "local_then_llm":
+            apply_recommendation(session, session.patterns.recommend())
+        session_store.save(session)
+
+    # --- 분석 요청 및 UI 업데이트 ---
+    if should_analyze:
+        request_analysis(context, query, user_id)
+    if should_analyze or update_ui_only:
+        schedule_refresh(context, query, user_id)
+
+# --- 내장 HTTP 서버 (웹훅 수신용) ---
+class HTTPRequest:
+    __slots__ = ("method", "path", "query", "headers", "body")
+
+    def __init__(self, method, target, headers, body):
+        url = urlsplit(target)
+        self.method = method
+        self.path = url.path
+        self.query = dict(parse_qsl(url.query))
+        self.headers = headers  # 소문자 키
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body or b"null")
+
+def http_response(status, body=b"", content_type="text/plain; charset=utf-8"):
+    """핸들러가 반환하는 (상태코드, 본문, Content-Type) 튜플 생성"""
+    if isinstance(body, str):
+        body = body.encode()
+    return status, body, content_type
+
+def json_response(obj, status=200):
+    return http_response(status, json.dumps(obj, ensure_ascii=False, default=str), "application/json")
+
+class MiniHTTPServer:
+    """asyncio 스트림 위에 만든 작은 HTTP/1.1 서버 (추가 의존성 없음, keep-alive 지원)
+    route(method, path, handler) 로 등록한 async handler(request) 가 http_response 튜플을 반환한다."""
+
+    def __init__(self):
+        self.routes = {}
+        self._server = None
+        self._writers = set()
+        self._busy = set()
 
-        # --- UI 업데이트 및 분석 실행 ---
-        if should_analyze:
-            await update_message(context, query, user_id, is_analyzing=True)
-            await run_analysis(user_id)
-            await update_message(context, query, user_id, is_analyzing=False)
-        elif update_ui_only:
-            await update_message(context, query, user_id, is_analyzing=False)
+    def route(self, method, path, handler):
+        self.routes[(method, path)] = handler
+
+    async def start(self, host, port):
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        """새 연결을 막고, 처리 중인 요청이 끝나면 유휴 연결을 닫는다"""
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        while self._busy:
+            await asyncio.sleep(0.05)
+        for writer in list(self._writers):
+            writer.close()
+
+    async def _handle_connection(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                request = await asyncio.wait_for(self._read_request(reader), HTTP_KEEPALIVE_TIMEOUT)
+                if request is None:
+                    break
+                self._busy.add(writer)
+                try:
+                    status, body, content_type = await self._dispatch(request)
+                    keep_alive = request.headers.get("connection", "").lower() != "close"
+                    head = (
+                        f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                        f"Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                    )
+                    writer.write(head.encode() + body)
+                    await writer.drain()
+                finally:
+                    self._busy.discard(writer)
+                if not keep_alive or self._server is None or not self._server.is_serving():
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        method, target, _ = line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length") or 0)
+        if length > HTTP_MAX_BODY:
+            raise ValueError("요청 본문이 너무 큽니다.")
+        body = await reader.readexactly(length) if length else b""
+        return HTTPRequest(method, target, headers, body)
+
+    async def _dispatch(self, request):
+        handler = self.routes.get((request.method, request.path))
+        if handler is None:
+            known = any(path == request.path for _, path in self.routes)
+            return http_response(405 if known else 404, "method not allowed" if known else "not found")
+        try:
+            return await handler(request)
+        except Exception as e:
+            print(f"HTTP 요청 처리 오류 ({request.method} {request.path}): {e}")
+            return http_response(500, "internal error")
+
+def make_webhook_handler(deliver, secret=None):
+    """텔레그램 웹훅 요청을 검증해 업데이트(dict)를 deliver 로 넘기는 핸들러
+    deliver 는 잘못된 업데이트면 False 를 반환하는 async 함수"""
+    async def handle(request):
+        token = request.headers.get("x-telegram-bot-api-secret-token", "")
+        if secret and not hmac.compare_digest(token.encode(), secret.encode()):
+            return http_response(403, "forbidden")
+        try:
+            data = request.json()
+            if not isinstance(data, dict) or not await deliver(data):
+                return http_response(400, "bad update")
+        except (ValueError, TypeError, KeyError):
+            return http_response(400, "bad update")
+        return http_response(200, "ok")
+    return handle
+
+def application_deliver(application):
+    """업데이트를 Application 의 update_queue 로 넣는 deliver 함수"""
+    async def deliver(data):
+        update = Update.de_json(data, application.bot)
+        if update is None:
+            return False
+        await application.update_queue.put(update)
+        return True
+    return deliver
+
+async def metrics_handler(request):
+    return http_response(200, metrics.render(), "text/plain; version=0.0.4; charset=utf-8")
+
+async def health_handler(request):
+    return json_response({
+        "status": "ok", "sessions": len(session_store), "outbound": outbound.stats(), "startup": startup.stats(),
+    })
+
+# --- 관리자 통계 API ---
+def admin_users(params, limit):
+    """사용자 목록 (user_id 오름차순, after= 이후)"""
+    after = int(params.get("after", 0))
+    rows = get_db_conn().execute(
+        """SELECT u.user_id, u.username, u.first_seen, u.last_seen, COALESCE(f.win_total, 0), COALESCE(f.loss_total, 0)
+        FROM users u LEFT JOIN feedback_counters f ON f.user_id = u.user_id
+        WHERE u.user_id > ? ORDER BY u.user_id LIMIT ?""",
+        (after, limit),
+    ).fetchall()
+    items = [
+        {"user_id": r[0], "username": r[1], "first_seen": r[2], "last_seen": r[3], "ai_win": r[4], "ai_loss": r[5]}
+        for r in rows
+    ]
+    return {"items": items, "next": rows[-1][0] if len(rows) == limit else None}
+
+def admin_rollups(params, limit):
+    """시간/일 단위 롤업 (최신 버킷부터, before= 이전)
+    버킷마다 활성 사용자 수, 액션별 클릭 수, AI 승/패와 적중률"""
+    period = params.get("period", "hour")
+    if period not in dict(ROLLUP_PERIODS):
+        raise ValueError(period)
+    conn = get_db_conn()
+    buckets = [row[0] for row in conn.execute(
+        "SELECT DISTINCT bucket FROM analytics_rollups WHERE period = ? AND bucket < ? ORDER BY bucket DESC LIMIT ?",
+        (period, params.get("before", "9999"), limit),
+    )]
+    if not buckets:
+        return {"items": [], "next": None}
+    span = (period, buckets[-1], buckets[0])
+    items = {bucket: {"bucket": bucket, "active_users": 0, "actions": {}, "ai": {"win": 0, "loss": 0}} for bucket in buckets}
+    for bucket, metric, value in conn.execute(
+        "SELECT bucket, metric, value FROM analytics_rollups WHERE period = ? AND bucket BETWEEN ? AND ?", span
+    ):
+        kind, _, name = metric.partition(":")
+        items[bucket]["ai" if kind == "ai" else "actions"][name] = value
+    for bucket, count in conn.execute(
+        "SELECT bucket, COUNT(*) FROM analytics_active WHERE period = ? AND bucket BETWEEN ? AND ? GROUP BY bucket", span
+    ):
+        if bucket in items:
+            items[bucket]["active_users"] = count
+    for item in items.values():
+        decided = item["ai"]["win"] + item["ai"]["loss"]
+        item["ai"]["win_rate"] = round(item["ai"]["win"] / decided, 4) if decided else None
+    return {"items": list(items.values()), "next": buckets[-1] if len(buckets) == limit else None}
+
+def admin_activity(params, limit):
+    """보관 전 activity 원본 (activity_id 내림차순, before= 이전, user_id= 로 사용자 한정)"""
+    before = int(params.get("before", 2 ** 63 - 1))
+    conn = get_db_conn()
+    if "user_id" in params:
+        rows = conn.execute(
+            """SELECT activity_id, user_id, timestamp, action, details FROM activity
+            WHERE user_id = ? AND activity_id < ? ORDER BY activity_id DESC LIMIT ?""",
+            (int(params["user_id"]), before, limit),
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            """SELECT activity_id, user_id, timestamp, action, details FROM activity
+            WHERE activity_id < ? ORDER BY activity_id DESC LIMIT ?""",
+            (before, limit),
+        ).fetchall()
+    items = [
+        {"activity_id": r[0], "user_id": r[1], "timestamp": r[2], "action": r[3], "details": r[4]} for r in rows
+    ]
+    return {"items": items, "next": rows[-1][0] if len(rows) == limit else None}
+
+def admin_handler(query_fn):
+    """Authorization: Bearer ADMIN_TOKEN 을 확인하고 query_fn(params, limit) 결과를 JSON 으로 돌려주는 핸들러
+    DB 조회는 이벤트 루프를 막지 않도록 스레드에서 실행한다."""
+    async def handle(request):
+        token = request.headers.get("authorization", "")
+        if not hmac.compare_digest(token.encode(), f"Bearer {ADMIN_TOKEN}".encode()):
+            return http_response(401, "unauthorized")
+        try:
+            limit = int(request.query.get("limit", ADMIN_PAGE_SIZE))
+            if not 0 < limit <= ADMIN_MAX_PAGE_SIZE:
+                raise ValueError(limit)
+            result = await asyncio.to_thread(query_fn, request.query, limit)
+        except ValueError:
+            return http_response(400, "bad request")
+        return json_response(result)
+    return handle
+
+def add_admin_routes(server):
+    """ADMIN_TOKEN 이 설정되어 있으면 관리자 API 경로를 등록"""
+    if not ADMIN_TOKEN:
+        return
+    server.route("GET", "/admin/users", admin_handler(admin_users))
+    server.route("GET", "/admin/rollups", admin_handler(admin_rollups))
+    server.route("GET", "/admin/activity", admin_handler(admin_activity))
+
+# --- 멀티 프로세스 샤딩 ---
+def shard_for_user(user_id, shards):
+    """user_id 를 0 ~ shards-1 중 하나로 고정 배정 (같은 사용자는 항상 같은 워커)"""
+    digest = hashlib.blake2b(str(user_id).encode(), digest_size=4).digest()
+    return int.from_bytes(digest, "big") % shards
+
+def update_user_id(data):
+    """업데이트(dict)를 보낸 사용자의 id (없으면 None)"""
+    for value in data.values():
+        if isinstance(value, dict) and isinstance(value.get("from"), dict):
+            return value["from"].get("id")
+    return None
+
+def ignore_stop_signals():
+    """자식 프로세스는 종료 신호를 무시하고 부모 프로세스의 순서에 따라 종료"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+def make_bot():
+    kwargs = {"base_url": TELEGRAM_API_URL.rstrip("/") + "/bot"} if TELEGRAM_API_URL else {}
+    return Bot(TELEGRAM_BOT_TOKEN, **kwargs)
+
+async def set_webhook(bot):
+    # 재시작 중에 쌓인 클릭도 처리하도록 대기 중인 업데이트는 버리지 않음
+    await bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=max(1, min(100, CONCURRENT_UPDATES * SHARD_COUNT)),
+    )
+
+class ShardCluster:
+    """user_id 해시로 사용자를 나눠 맡는 워커 프로세스들과 DB 쓰기 전용 프로세스 묶음
+    - 부모 프로세스는 업데이트를 받아 해당 사용자의 워커로 전달만 한다 (세션/잠금은 워커 안에서만 유효)
+    - 모든 DB 쓰기는 하나의 프로세스가 하나의 연결로 처리해 WAL 쓰기 경합이 없다 (읽기는 각 워커가 직접)
+    - 죽은 프로세스는 check() 에서 같은 큐로 다시 띄운다"""
+
+    def __init__(self, shards=SHARD_COUNT):
+        self.ctx = multiprocessing.get_context("spawn")
+        self.shards = shards
+        self.db_channel = self.ctx.Queue(DB_QUEUE_MAX)
+        self.acks = [self.ctx.Event() for _ in range(shards)]
+        self.inboxes = [self.ctx.Queue() for _ in range(shards)]
+        self.routed = [0] * shards
+        self.restarts = 0
+        self.writer = None
+        self.workers = [None] * shards
+        self._stopping = False
+
+    def start(self):
+        self.writer = self._spawn_writer()
+        for i in range(self.shards):
+            self.workers[i] = self._spawn_worker(i)
+
+    def _spawn_writer(self):
+        process = self.ctx.Process(target=run_db_writer, args=(self.db_channel, self.acks), name="db-writer")
+        process.start()
+        return process
+
+    def _spawn_worker(self, i):
+        process = self.ctx.Process(
+            target=run_shard, args=(i, self.shards, self.inboxes[i], self.db_channel, self.acks[i]), name=f"shard-{i}"
+        )
+        process.start()
+        return process
+
+    async def deliver(self, data):
+        """업데이트(dict)를 보낸 사용자를 맡은 워커로 전달"""
+        if "update_id" not in data:
+            return False
+        user_id = update_user_id(data)
+        i = shard_for_user(user_id, self.shards) if user_id is not None else 0
+        self.inboxes[i].put(json.dumps(data))
+        self.routed[i] += 1
+        return True
+
+    def check(self):
+        """죽은 워커/DB 쓰기 프로세스를 다시 시작"""
+        if self._stopping:
+            return
+        if not self.writer.is_alive():
+            print(f"DB 쓰기 프로세스가 종료되어 다시 시작합니다. (exit {self.writer.exitcode})")
+            self.writer = self._spawn_writer()
+            self.restarts += 1
+        for i, process in enumerate(self.workers):
+            if not process.is_alive():
+                print(f"샤드 {i} 워커가 종료되어 다시 시작합니다. (exit {process.exitcode})")
+                self.workers[i] = self._spawn_worker(i)
+                self.restarts += 1
+
+    def stats(self):
+        return {
+            "shards": self.shards,
+            "alive": [process.is_alive() for process in self.workers],
+            "routed": self.routed,
+            "restarts": self.restarts,
+        }
+
+    def stop(self, timeout=30):
+        """워커들이 받은 업데이트를 모두 처리하게 한 뒤, 마지막으로 DB 쓰기 프로세스를 종료"""
+        self._stopping = True
+        for inbox in self.inboxes:
+            inbox.put(None)
+        deadline = time.monotonic() + timeout
+        for process in self.workers:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+        self.db_channel.put(DBWriter._STOP)
+        self.writer.join(max(1, deadline - time.monotonic()))
+        if self.writer.is_alive():
+            self.writer.terminate()
+
+def run_shard(index, shards, inbox, db_channel, ack):
+    """샤드 워커 프로세스: 부모가 넘겨준 업데이트를 자체 Application 으로 처리"""
+    global db_writer, METRICS_PORT
+    ignore_stop_signals()
+    db_writer = ShardDBWriter(db_channel, index, ack)
+    if METRICS_PORT:
+        METRICS_PORT += index + 1  # 부모 프로세스와 겹치지 않게 워커별 포트 사용
+    start_instrumentation(f".shard{index}")
+    startup.begin(migrate=False)
+    # 텔레그램 전체 호출 한도를 워커 수로 나눠 갖는다 (채팅별 한도는 사용자가 한 워커에만 있으므로 그대로)
+    outbound.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE / shards, TELEGRAM_GLOBAL_RATE / shards)
+    asyncio.run(_shard_loop(build_application(), inbox))
+
+async def _shard_loop(application, inbox):
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    await on_init(application)
+    await application.start()
+    try:
+        while True:
+            data = await loop.run_in_executor(None, inbox.get)
+            if data is None:
+                break
+            update = Update.de_json(json.loads(data), application.bot)
+            if update is not None:
+                await application.update_queue.put(update)
+    finally:
+        await application.stop()
+        await on_stop(application)
+        await application.shutdown()
+        await on_shutdown(application)
+
+async def poll_updates(bot, deliver):
+    """getUpdates 롱폴링으로 받은 업데이트를 deliver 로 넘긴다 (샤딩 모드의 polling)"""
+    await bot.delete_webhook(drop_pending_updates=True)
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=25, allowed_updates=Update.ALL_TYPES)
+        except NetworkError as e:
+            print(f"업데이트 수신 오류: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            await deliver(update.to_dict())
+
+async def run_sharded() -> None:
+    """샤딩 모드 실행: 이 프로세스는 업데이트 수신과 워커 관리만 담당"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    cluster = ShardCluster()
+    cluster.start()
+    try:
+        async with make_bot() as bot:
+            server, poller = None, None
+            try:
+                if BOT_MODE == "webhook":
+                    server = MiniHTTPServer()
+                    server.route("POST", WEBHOOK_PATH, make_webhook_handler(cluster.deliver, WEBHOOK_SECRET))
+                    server.route("GET", "/healthz", make_cluster_health_handler(cluster))
+                    add_admin_routes(server)
+                    port = await server.start(WEBHOOK_LISTEN, WEBHOOK_PORT)
+                    if WEBHOOK_URL:
+                        await set_webhook(bot)
+                    print(f"텔레그램 봇이 웹훅 모드로 시작되었습니다... (port {port}, 워커 {cluster.shards}개)")
+                else:
+                    poller = asyncio.create_task(poll_updates(bot, cluster.deliver))
+                    print(f"텔레그램 봇이 시작되었습니다... (워커 {cluster.shards}개)")
+                while not stop.is_set():
+                    try:
+                        await asyncio.wait_for(stop.wait(), 1)
+                    except asyncio.TimeoutError:
+                        cluster.check()
+                    if poller and poller.done():
+                        poller.result()
+            finally:
+                if server:
+                    await server.close()
+                if poller:
+                    poller.cancel()
+                    await asyncio.gather(poller, return_exceptions=True)
+    finally:
+        await asyncio.to_thread(cluster.stop)
+
+def make_cluster_health_handler(cluster):
+    async def handle(request):
+        return json_response({"status": "ok", **cluster.stats()})
+    return handle
 
 # --- 메인 실행 ---
+class Startup:
+    """부팅 준비 작업과 콜드 스타트 시간 기록
+    DB 마이그레이션, 렌더링 자원, OpenAI 클라이언트를 백그라운드 스레드에서 동시에 준비하고
+    단계별 소요 시간, 업데이트를 받을 준비가 된 시각, 첫 업데이트 처리 시간을 메트릭과 로그로 남긴다."""
+
+    def __init__(self, began=BOOT_STARTED):
+        self.began = began
+        self.phases = {}  # 단계 -> 소요 시간(초)
+        self.ready_seconds = None
+        self.first_update_seconds = None
+        self._threads = {}
+        self._errors = {}
+
+    def begin(self, migrate=True):
+        """준비 작업 시작 (migrate=False: 부모 프로세스가 이미 마이그레이션한 샤드 워커)"""
+        self._record("import", time.perf_counter() - self.began)
+        tasks = {"assets": road_renderer.load_assets, "openai": get_openai_client, "render_pool": render_pool.start}
+        if migrate:
+            tasks["db"] = setup_database
+        for name, target in tasks.items():
+            thread = threading.Thread(target=self._run, args=(name, target), name=f"startup-{name}", daemon=True)
+            self._threads[name] = thread
+            thread.start()
+
+    def _run(self, name, target):
+        started = time.perf_counter()
+        try:
+            target()
+        except Exception as e:
+            self._errors[name] = e
+            print(f"부팅 준비 작업 실패 ({name}): {e}")
+        self._record(name, time.perf_counter() - started)
+
+    def _record(self, phase, seconds):
+        self.phases[phase] = seconds
+        metrics.set("startup_seconds", round(seconds, 6), phase=phase)
+
+    async def ready(self):
+        """DB 마이그레이션이 끝날 때까지 기다린 뒤 (실패하면 예외) 부팅 완료 시간을 기록
+        이벤트 루프 스레드의 DB 연결도 여기서 미리 연다."""
+        thread = self._threads.get("db")
+        if thread:
+            await asyncio.to_thread(thread.join)
+            if "db" in self._errors:
+                raise self._errors["db"]
+        get_db_conn()
+        if self.ready_seconds is None:
+            self.ready_seconds = time.perf_counter() - self.began
+            self._record("ready", self.ready_seconds)
+            phases = ", ".join(f"{name} {seconds:.2f}초" for name, seconds in self.phases.items() if name != "ready")
+            print(f"부팅 완료: {self.ready_seconds:.2f}초 ({phases})")
+
+    def record_first_update(self, stage, seconds):
+        self.first_update_seconds = seconds
+        metrics.set("first_update_seconds", round(seconds, 6), stage=stage)
+        print(f"첫 업데이트 처리: {stage} {seconds * 1000:.1f}ms (시작 후 {time.perf_counter() - self.began:.1f}초)")
+
+    def stats(self):
+        return {
+            "phases": {name: round(seconds, 4) for name, seconds in self.phases.items()},
+            "first_update_seconds": self.first_update_seconds,
+        }
+
+startup = Startup()
+
+async def on_init(application: Application) -> None:
+    """부팅 준비(DB 마이그레이션)를 기다리고, METRICS_PORT 가 있으면 /metrics 전용 HTTP 서버를 띄움"""
+    global metrics_server
+    await startup.ready()
+    if METRICS_PORT and metrics_server is None:
+        metrics_server = MiniHTTPServer()
+        metrics_server.route("GET", "/metrics", metrics_handler)
+        metrics_server.route("GET", "/healthz", health_handler)
+        add_admin_routes(metrics_server)
+        await metrics_server.start(WEBHOOK_LISTEN, METRICS_PORT)
+
+async def on_stop(application: Application) -> None:
+    """업데이트 처리가 끝난 뒤 남은 분석/화면 갱신 작업과 텔레그램 발신 대기열을 마무리"""
+    await drain_background_tasks()
+    await outbound.join()
+
+async def on_shutdown(application: Application) -> None:
+    """봇 종료 시 대기 중인 DB 로그와 세션을 모두 기록"""
+    await asyncio.to_thread(db_writer.close)
+    await asyncio.to_thread(render_pool.close)
+    if metrics_server:
+        await metrics_server.close()
+
+async def run_webhook(application: Application) -> None:
+    """웹훅 모드 실행
+    종료 신호(SIGTERM/SIGINT)를 받으면 새 요청 수신을 멈추고, 대기/처리 중인 업데이트와 DB 쓰기를 마친 뒤 종료"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    server = MiniHTTPServer()
+    server.route("POST", WEBHOOK_PATH, make_webhook_handler(application_deliver(application), WEBHOOK_SECRET))
+    server.route("GET", "/healthz", health_handler)
+    server.route("GET", "/metrics", metrics_handler)
+    add_admin_routes(server)
+
+    await application.initialize()
+    await on_init(application)
+    await application.start()
+    try:
+        port = await server.start(WEBHOOK_LISTEN, WEBHOOK_PORT)
+        if WEBHOOK_URL:
+            await set_webhook(application.bot)
+        print(f"텔레그램 봇이 웹훅 모드로 시작되었습니다... (port {port}, 동시 처리 {CONCURRENT_UPDATES})")
+        await stop.wait()
+    finally:
+        await server.close()
+        await application.stop()
+        await on_stop(application)
+        await application.shutdown()
+        await on_shutdown(application)
+
+def build_application(request=None) -> Application:
+    """핸들러를 등록한 Application 생성 (request: 벤치마크 등에서 쓰는 BaseRequest 대체 구현)"""
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(on_init)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if request is not None:
+        builder = builder.request(request)
+    elif TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL.rstrip("/") + "/bot")
+    application = builder.build()
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CallbackQueryHandler(button_callback))
+    return application
+
 def main() -> None:
+    global WEBHOOK_SECRET
     if not all([OPENAI_API_KEY, TELEGRAM_BOT_TOKEN]):
         print("ERROR: 환경변수 OPENAI_API_KEY, TELEGRAM_BOT_TOKEN 설정이 필요합니다.")
         return
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        # secret token 없이 웹훅을 열면 누구나 업데이트를 위조해 보낼 수 있음
+        if not WEBHOOK_URL:
+            print("ERROR: 웹훅 모드에서 setWebhook 을 직접 하려면 환경변수 WEBHOOK_SECRET 설정이 필요합니다.")
+            return
+        WEBHOOK_SECRET = secrets.token_urlsafe(32)
     
-    setup_database()
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CallbackQueryHandler(button_callback))
-    
+    if SHARD_COUNT > 1:
+        setup_database()
+        asyncio.run(run_sharded())
+        return
+    start_instrumentation()
+    startup.begin()
+    application = build_application()
+
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(application))
+        return
     print("텔레그램 봇이 시작되었습니다...")
     application.run_polling(drop_pending_updates=True)
 
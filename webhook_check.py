@@ -0,0 +1,214 @@
+# 웹훅 모드 점검 스크립트
+# 가짜 Bot API 서버를 띄우고 telegram_bot.py 를 BOT_MODE=webhook 으로 실행한 뒤,
+# 텔레그램 서버처럼 /telegram 에 업데이트를 POST 해서 다음을 확인한다.
+#   - secret token 이 없거나 틀린 요청은 403, 업데이트가 아닌 본문은 400, 정상 업데이트는 200
+#   - 200 을 받은 업데이트는 곧바로 SIGTERM 을 보내도 모두 처리되어 DB 에 남고, 봇은 종료 코드 0 으로 끝난다
+#
+# 사용 예)
+#   python webhook_check.py                          # 단일 프로세스 웹훅
+#   python webhook_check.py --shards 3               # 샤딩 모드 웹훅
+#   python webhook_check.py --users 50 --clicks 40 --api-latency 0.05
+# 하나라도 실패하면 종료 코드 1
+
+import os
+import sys
+import json
+import time
+import random
+import signal
+import socket
+import asyncio
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+
+# telegram_bot 은 import 시점에 환경변수를 읽으므로 먼저 가짜 값을 넣는다 (여기서는 MiniHTTPServer 만 씀)
+TOKEN = "123456:webhook-check"
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", TOKEN)
+
+import telegram_bot as bot
+from bench_bot import BOT_ID, start_update, callback_update
+
+SECRET = "webhook-check-secret"
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "telegram_bot.py")
+
+
+# --- 가짜 Bot API 서버 ---
+class FakeBotAPI:
+    """봇이 호출하는 Bot API 메서드에 지연 시간 후 성공 응답을 돌려주고 호출 수를 센다"""
+    METHODS = (
+        "getMe", "setWebhook", "deleteWebhook", "answerCallbackQuery", "sendMessage",
+        "sendPhoto", "editMessageMedia", "editMessageCaption", "editMessageReplyMarkup",
+    )
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = {}
+        self.server = bot.MiniHTTPServer()
+        for method in self.METHODS:
+            self.server.route("POST", f"/bot{TOKEN}/{method}", self._handler(method))
+
+    def _handler(self, method):
+        async def handle(request):
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if method == "getMe":
+                result = {"id": BOT_ID, "is_bot": True, "first_name": "check", "username": "check_bot"}
+            elif method in ("sendPhoto", "sendMessage") or method.startswith("editMessage"):
+                result = {
+                    "message_id": 1, "date": int(time.time()), "chat": {"id": 0, "type": "private"},
+                    "photo": [{"file_id": f"check-{method}", "file_unique_id": "u", "width": 440, "height": 162}],
+                }
+            else:
+                result = True
+            return bot.json_response({"ok": True, "result": result})
+        return handle
+
+
+# --- 가짜 텔레그램 클라이언트 ---
+async def request(port, method, path, body=b"", headers=None):
+    """HTTP 요청 하나를 보내고 (상태코드, 본문) 반환"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    head = f"{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Length: {len(body)}\r\nConnection: close\r\n"
+    for name, value in (headers or {}).items():
+        head += f"{name}: {value}\r\n"
+    writer.write(head.encode() + b"\r\n" + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    status_line, _, rest = response.partition(b"\r\n")
+    return int(status_line.split()[1]), rest.partition(b"\r\n\r\n")[2]
+
+async def post_update(port, data, secret=SECRET):
+    headers = {"Content-Type": "application/json"}
+    if secret is not None:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+    body = data if isinstance(data, bytes) else json.dumps(data).encode()
+    status, _ = await request(port, "POST", bot.WEBHOOK_PATH, body, headers)
+    return status
+
+async def wait_ready(port, proc, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"봇이 시작 중에 종료되었습니다 (종료 코드 {proc.returncode})")
+        try:
+            status, _ = await request(port, "GET", "/healthz")
+            if status == 200:
+                return
+        except OSError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("봇이 제한 시간 안에 웹훅 요청을 받지 못했습니다")
+
+async def wait_calls(api, method, count, timeout=30):
+    deadline = time.monotonic() + timeout
+    while api.calls.get(method, 0) < count and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# --- 점검 ---
+class Checks:
+    def __init__(self):
+        self.failed = 0
+
+    def expect(self, name, ok, detail=""):
+        self.failed += not ok
+        print(f"  [{'OK' if ok else '실패'}] {name}{f' ({detail})' if detail else ''}")
+
+async def run_check(args):
+    rng = random.Random(args.seed)
+    checks = Checks()
+    api = FakeBotAPI(args.api_latency)
+    api_port = await api.server.start("127.0.0.1", 0)
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix="baccarat-webhook-")
+    env = dict(
+        os.environ,
+        TELEGRAM_BOT_TOKEN=TOKEN, OPENAI_API_KEY="unused", TELEGRAM_API_URL=f"http://127.0.0.1:{api_port}",
+        BOT_MODE="webhook", WEBHOOK_SECRET=SECRET, WEBHOOK_LISTEN="127.0.0.1", PORT=str(port),
+        SHARDS=str(args.shards), RENDER_PROCESSES=str(args.render_processes), RECOMMENDER_MODE="local",
+    )
+    env.pop("WEBHOOK_URL", None)
+    env.pop("METRICS_PORT", None)
+    proc = subprocess.Popen([sys.executable, BOT_SCRIPT], cwd=workdir, env=env)
+    try:
+        await wait_ready(port, proc)
+        print(f"\n[웹훅 점검] 샤드 {args.shards}, 렌더링 프로세스 {args.render_processes}, 작업 폴더 {workdir}")
+
+        users = [1000 + i for i in range(args.users)]
+        ids = iter(range(1, 10 ** 9))
+        probe = callback_update(next(ids), users[0], "P")
+        checks.expect("secret token 없음 -> 403", await post_update(port, probe, secret=None) == 403)
+        checks.expect("secret token 틀림 -> 403", await post_update(port, probe, secret="wrong") == 403)
+        checks.expect("JSON 이 아닌 본문 -> 400", await post_update(port, b"not json") == 400)
+        checks.expect("업데이트가 아닌 JSON -> 400", await post_update(port, [1, 2]) == 400)
+
+        # /start 가 먼저 처리되어야 이후 클릭이 초기화되지 않으므로 첫 화면 전송까지 기다린 뒤 클릭을 보낸다
+        statuses = await asyncio.gather(*(post_update(port, start_update(next(ids), user)) for user in users))
+        checks.expect("/start 업데이트 -> 200", set(statuses) == {200}, f"{statuses.count(200)}/{len(statuses)}")
+        await wait_calls(api, "sendPhoto", len(users))
+
+        clicks = {user: rng.choices("PBT", weights=(45, 46, 9), k=args.clicks) for user in users}
+
+        async def click_through(user):
+            return [await post_update(port, callback_update(next(ids), user, action)) for action in clicks[user]]
+
+        results = await asyncio.gather(*(click_through(user) for user in users))
+        accepted = sum(status == 200 for statuses in results for status in statuses)
+        total = len(users) * args.clicks
+        checks.expect("버튼 클릭 업데이트 -> 200", accepted == total, f"{accepted}/{total}")
+
+        # 처리 중인 업데이트가 남아 있는 상태에서 바로 종료 신호
+        stop_started = time.perf_counter()
+        proc.send_signal(signal.SIGTERM)
+        try:
+            returncode = await asyncio.wait_for(asyncio.to_thread(proc.wait), args.stop_timeout)
+        except asyncio.TimeoutError:
+            returncode = None
+        stop_seconds = time.perf_counter() - stop_started
+        checks.expect("SIGTERM 후 정상 종료", returncode == 0, f"종료 코드 {returncode}, {stop_seconds:.2f}초")
+
+        conn = sqlite3.connect(os.path.join(workdir, bot.DB_FILE))
+        starts = conn.execute("SELECT COUNT(*) FROM activity WHERE action = 'start'").fetchone()[0]
+        logged = conn.execute("SELECT COUNT(*) FROM activity WHERE action = 'button_click'").fetchone()[0]
+        histories = dict(conn.execute("SELECT user_id, history FROM sessions").fetchall())
+        conn.close()
+        checks.expect("/start 가 모두 기록됨", starts == len(users), f"{starts}/{len(users)}")
+        # 403/400 으로 거절한 요청은 기록되면 안 된다
+        checks.expect("200 을 받은 클릭만 모두 기록됨", logged == accepted, f"{logged}/{accepted}")
+        missing = [user for user in users if (histories.get(user) or b"") != "".join(clicks[user]).encode()]
+        checks.expect("세션 기록이 보낸 클릭과 같음", not missing, f"다른 사용자 {len(missing)}명" if missing else "")
+        answered = api.calls.get("answerCallbackQuery", 0)
+        checks.expect("콜백 응답(answerCallbackQuery)이 모두 전송됨", answered == accepted, f"{answered}/{accepted}")
+        print(f"  Bot API 호출 {api.calls}")
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        await api.server.close()
+    return checks.failed
+
+def main():
+    parser = argparse.ArgumentParser(description="바카라 봇 웹훅 모드 점검 (가짜 Bot API + 가짜 텔레그램 클라이언트)")
+    parser.add_argument("--users", type=int, default=10, help="가상 사용자 수")
+    parser.add_argument("--clicks", type=int, default=20, help="사용자별 P/B/T 클릭 수")
+    parser.add_argument("--shards", type=int, default=1, help="SHARDS 환경변수 (1이면 단일 프로세스)")
+    parser.add_argument("--render-processes", type=int, default=0, help="RENDER_PROCESSES 환경변수")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="가짜 Bot API 응답 지연(초)")
+    parser.add_argument("--stop-timeout", type=float, default=60, help="SIGTERM 후 종료를 기다릴 최대 시간(초)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    failed = asyncio.run(run_check(args))
+    print(f"\n{'모든 점검 통과' if not failed else f'{failed}개 점검 실패'}")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()